@@ -0,0 +1,217 @@
+"""Benchmarks for scanning, filling and querying the index.
+
+Generates a synthetic source tree and tags file, indexes them and measures
+scan throughput, insert rate and per-keystroke query latency. Run from the
+`rplugin/python3` directory:
+
+    python -m zem.benchmark --files 10000 --tags 100000 --output bench.json
+
+Results are written as JSON, so runs can be compared.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import pathlib
+import platform
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from . import scanner
+from .db import DB
+from .query import tokenize
+
+SYLLABLES = [
+    "get", "set", "init", "buf", "file", "name", "list", "node", "tree", "map",
+    "read", "write", "open", "close", "data", "item", "size", "count", "ptr",
+    "str", "cfg", "log", "err", "msg", "req", "resp", "key", "val", "idx", "tmp",
+]  # fmt: skip
+
+
+def identifier(rnd):
+    parts = [rnd.choice(SYLLABLES) for _ in range(rnd.randint(1, 4))]
+    if rnd.random() < 0.5:
+        return "_".join(parts)
+    return parts[0] + "".join(p.capitalize() for p in parts[1:])
+
+
+def generate_tree(root, file_count, lines_per_file, fanout, rnd):
+    """Create file_count source files below root, return their paths."""
+    paths = []
+    for i in range(file_count):
+        d = root
+        n = i // fanout
+        while n:
+            d = d / "d{}".format(n % fanout)
+            n //= fanout
+        d.mkdir(parents=True, exist_ok=True)
+        p = d / "{}_{}.c".format(identifier(rnd), i)
+        with p.open("wt") as f:
+            for _ in range(lines_per_file):
+                f.write(
+                    "    {} = {}({});\n".format(
+                        identifier(rnd), identifier(rnd), identifier(rnd)
+                    )
+                )
+        paths.append(p.relative_to(root).as_posix())
+    (root / ".gitignore").write_text("*.o\nbuild/\n")
+    return paths
+
+
+def generate_tags(path, tag_count, files, rnd):
+    kinds = "fpdvstm"
+    with path.open("wt") as f:
+        f.write("!_TAG_FILE_FORMAT\t2\n")
+        for i in range(tag_count):
+            name = identifier(rnd)
+            f.write(
+                '{}\t{}\t{};"\t{}\n'.format(
+                    name, rnd.choice(files), rnd.randint(1, 1000), rnd.choice(kinds)
+                )
+            )
+
+
+def keystroke_queries(rnd, count):
+    """Yield the prompt contents while typing count random identifiers."""
+    for _ in range(count):
+        word = identifier(rnd).lower()
+        for i in range(1, min(len(word), 8) + 1):
+            yield word[:i]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def p(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    return {
+        "count": len(samples),
+        "mean": statistics.fmean(samples),
+        "p50": p(0.50),
+        "p95": p(0.95),
+        "p99": p(0.99),
+        "max": samples[-1],
+    }
+
+
+def bench_scan(func, settings):
+    t = time.perf_counter()
+    count = sum(1 for _ in func(settings))
+    t = time.perf_counter() - t
+    return {"rows": count, "seconds": t, "rows_per_second": count / t if t else None}
+
+
+def bench_fill(db, sources, batch_size):
+    t = time.perf_counter()
+    count = 0
+    db.begin_update()
+    db.fill([])
+    for name, func, settings in sources:
+        index = scanner.FileIndex()
+        rows = func(settings, index)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            count += len(batch)
+            db.add_rows(name, index, batch)
+        db.finish_source(name, index)
+    db.commit_update()
+    t = time.perf_counter() - t
+    return {"rows": count, "seconds": t, "rows_per_second": count / t if t else None}
+
+
+def bench_queries(db, queries, limit):
+    latencies = []
+    for q in queries:
+        t = time.perf_counter()
+        db.get(tokenize(q), limit=limit)
+        latencies.append((time.perf_counter() - t) * 1000)
+    return {"latency_ms": percentiles(latencies)}
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    results = {
+        "params": vars(args),
+        "platform": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+        },
+        "results": {},
+    }
+    res = results["results"]
+
+    with tempfile.TemporaryDirectory(prefix="zem-bench-") as tmp:
+        root = pathlib.Path(tmp) / "tree"
+        t = time.perf_counter()
+        files = generate_tree(root, args.files, args.lines, args.fanout, rnd)
+        generate_tags(root / "tags", args.tags, files, rnd)
+        res["generate_seconds"] = time.perf_counter() - t
+
+        cwd = os.getcwd()
+        os.chdir(root)
+        try:
+            sources = [
+                ("files", scanner.files, {}),
+                ("lines", scanner.lines, {}),
+                ("words", scanner.words, {}),
+                ("tags", scanner.tags, {"file": "tags"}),
+            ]
+            sources = [s for s in sources if s[0] in args.sources]
+            for name, func, settings in sources:
+                res["scan_" + name] = bench_scan(func, settings)
+
+            db = DB(str(pathlib.Path(tmp) / "zem.sqlite"), name_index=args.name_index)
+            try:
+                res["fill"] = bench_fill(db, sources, args.batch_size)
+                res["db_rows"] = db.get_size()
+                queries = list(keystroke_queries(rnd, args.queries))
+                res["query"] = bench_queries(db, queries, args.limit)
+                # the candidate cache must not make typing slower than no cache
+                for r in db._readers:
+                    r.cache = None
+                res["query_uncached"] = bench_queries(db, queries, args.limit)
+            finally:
+                db.close()
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n")[0])
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--lines", type=int, default=20, help="lines per file")
+    parser.add_argument("--fanout", type=int, default=50, help="files per directory")
+    parser.add_argument("--tags", type=int, default=100000)
+    parser.add_argument(
+        "--sources", nargs="+", default=["files", "lines", "words", "tags"]
+    )
+    parser.add_argument("--queries", type=int, default=50, help="words to type")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--name-index", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "wt") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
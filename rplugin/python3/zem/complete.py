@@ -1,9 +1,141 @@
+import bisect
+import collections
 import itertools
+import os
+import threading
 from pathlib import Path
 
+CONTEXT_LINES = 5  # lines shown in the info of a completion
+
+
+def _unescape(loc):
+    """The line searched by a tag's regex location."""
+    # loc is a very-no-magic regex where only ^, $, / and \
+    # have meaaning
+    line = loc[2:-2]  # strip /^   $/,
+    line = line.replace("\\/", "/")
+    line = line.replace("\\$", "$")
+    line = line.replace("\\^", "^")
+    line = line.replace("\\\\", "\\")
+    return line
+
+
+def _read_info(path, loc):
+    """Like _File(path).info(loc), but reads no more of the file than needed."""
+    with open(path, "rt") as f:
+        if not loc:  # Head of File
+            return "".join(itertools.islice(f, 0, CONTEXT_LINES))
+        elif loc[0] == "/" == loc[-1]:  # Line -Regex
+            line = _unescape(loc)
+            for info in f:
+                if line == info[:-1]:
+                    break
+            else:
+                info = line
+            # Add the following lines if there are any left
+            return info + "".join(itertools.islice(f, 0, CONTEXT_LINES - 1))
+        else:  # Line Number
+            line_no = int(loc)
+            return "".join(
+                itertools.islice(f, line_no - 1, line_no - 1 + CONTEXT_LINES)
+            )
+
+
+class _File:
+    """The text of a file, indexed by the offsets of its lines."""
+
+    def __init__(self, path, stat):
+        self.mtime = stat.st_mtime_ns
+        self.size = stat.st_size
+        with open(path, "rt") as f:
+            self.text = f.read()
+        text = self.text
+        self.starts = [0]  # offset of each line
+        i = text.find("\n")
+        while i != -1:
+            self.starts.append(i + 1)
+            i = text.find("\n", i + 1)
+        if self.starts[-1] != len(text):
+            self.starts.append(len(text))  # end of the unterminated last line
+        self.snippets = {}  # location -> info
+
+    def lines(self, start, count=CONTEXT_LINES):
+        """count lines from line index start on."""
+        starts = self.starts
+        end = min(start + count, len(starts) - 1)
+        if start >= end:
+            return ""
+        return self.text[starts[start] : starts[end]]
+
+    def info(self, loc):
+        try:
+            return self.snippets[loc]
+        except KeyError:
+            pass
+        if not loc:  # Head of File
+            info = self.lines(0)
+        elif loc[0] == "/" == loc[-1]:  # Line -Regex
+            line = _unescape(loc)
+            if self.text.startswith(line + "\n"):
+                i = 0
+            else:
+                i = self.text.find("\n" + line + "\n")
+                if i != -1:
+                    i += 1
+            if i == -1:
+                info = line
+            else:
+                info = self.lines(bisect.bisect_right(self.starts, i) - 1)
+        else:  # Line Number
+            line_no = int(loc)
+            if line_no < 1:
+                raise ValueError("line numbers start at 1", line_no)
+            info = self.lines(line_no - 1)
+        self.snippets[loc] = info
+        return info
+
+
+class _FileCache:
+    """The most recently read files, reread when their mtime or size changes."""
+
+    MAX_ENTRIES = 32
+    MAX_CHARS = 32 * 2**20  # don't keep more text than this
+    MAX_FILE_SIZE = 2 * 2**20  # bigger files are not cached
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()  # path -> _File
+        self._lock = threading.Lock()
+
+    def get(self, path, load=True):
+        """The cached _File of path, None if it is not cached and not loaded.
+
+        Only files up to MAX_FILE_SIZE are loaded, and only if load is true.
+        """
+        st = os.stat(path)
+        with self._lock:
+            f = self._entries.get(path)
+            if f is not None and (f.mtime, f.size) == (st.st_mtime_ns, st.st_size):
+                self._entries.move_to_end(path)
+                return f
+        if not load or st.st_size > self.MAX_FILE_SIZE:
+            return None
+        f = _File(path, st)
+        with self._lock:
+            self._entries[path] = f
+            self._entries.move_to_end(path)
+            chars = sum(len(e.text) for e in self._entries.values())
+            while len(self._entries) > self.MAX_ENTRIES or chars > self.MAX_CHARS:
+                _, old = self._entries.popitem(last=False)
+                chars -= len(old.text)
+        return f
+
+
+_files = _FileCache()
+
 
 def completion_results(matches, cwd):
     res = []
+    files = {}  # matches in the same file share one lookup
     for m in matches:
         info = None
         try:
@@ -11,27 +143,15 @@ def completion_results(matches, cwd):
             file_name = Path(m["file"])
             if not file_name.is_absolute():
                 file_name = cwd / file_name
-            with file_name.open("rt") as f:
-                if not loc:  # Head of File
-                    info = "".join(itertools.islice(f, 0, 5))
-                elif loc[0] == "/" == loc[-1]:  # Line -Regex
-                    # loc is a very-no-magic regex where only ^, $, / and \
-                    # have meaaning
-                    loc = loc[2:-2]  # strip /^   $/,
-                    loc = loc.replace("\\/", "/")
-                    loc = loc.replace("\\$", "$")
-                    loc = loc.replace("\\^", "^")
-                    loc = loc.replace("\\\\", "\\")
-                    for info in f:
-                        if loc == info[:-1]:
-                            break
-                    else:
-                        info = loc
-                    # Add 4 lines if there are any left
-                    info += "".join(itertools.islice(f, 0, 4))
-                else:  # Line Number
-                    line_no = int(loc)
-                    info = "".join(itertools.islice(f, line_no - 1, line_no + 4))
+            f = files.get(file_name)
+            if f is None:
+                # the head of a file is read directly, unless it is cached
+                f = _files.get(file_name, load=bool(loc))
+            if f is None:
+                info = _read_info(file_name, loc)
+            else:
+                files[file_name] = f
+                info = f.info(loc)
         except (FileNotFoundError, ValueError):
             pass
         if not info:
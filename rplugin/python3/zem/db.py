@@ -1,14 +1,73 @@
+import collections
+import contextlib
+import json
 import logging
 import queue
+import re
 import sqlite3
+import threading
 import time
+import urllib.request
 
+from .query import refines
 from .threadworker import ThreadWorkerMixin as TWMI
 
 
-class DB(TWMI):
+class _CandidateCache:
+    """Rowids of all rows matching recent queries, least recently used first.
+
+    When a query only narrows a cached one (e.g. `fo` -> `foo`), only the
+    cached candidates need to be filtered again. Shared by all readers, and
+    invalidated whenever the index changes.
+    """
+
+    MAX_ENTRIES = 16
+    MAX_ROWS = 5000  # don't cache queries that match more rows than this
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()  # tokens -> rowids
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def store(self, tokens, rowids, generation):
+        """Remember rowids unless the index changed since generation."""
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[tuple(tokens)] = rowids
+            self._entries.move_to_end(tuple(tokens))
+            while len(self._entries) > self.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+
+    def lookup(self, tokens):
+        """Smallest cached candidate list that contains all matches of tokens."""
+        with self._lock:
+            best = None
+            for previous, rowids in self._entries.items():
+                if best is not None and len(rowids) >= len(self._entries[best]):
+                    continue
+                if refines(tokens, previous):
+                    best = previous
+            if best is None:
+                return None
+            self._entries.move_to_end(best)
+            return self._entries[best]
+
+
+class _Connection(TWMI):
+    """A sqlite connection and the worker thread that owns it."""
+
     _SCHEMA = """
         DROP TABLE IF EXISTS zem;
+        DROP TABLE IF EXISTS zem_files;
+        DROP TABLE IF EXISTS zem_dirs;
+        DROP TABLE IF EXISTS zem_gram;
+        DROP TABLE IF EXISTS zem_gram_count;
 
         CREATE TABLE zem (
             name        TEXT NOT NULL,
@@ -17,37 +76,145 @@ class DB(TWMI):
             extra       TEXT,
             location    TEXT,
             prio        INT NOT NULL,
-            subprio     INT NOT NULL
+            subprio     INT NOT NULL,
+            file_id     INT
         );
         CREATE INDEX zem_type ON zem(type);
+        CREATE INDEX zem_file_id ON zem(file_id);
+
+        CREATE TABLE zem_files (
+            id          INTEGER PRIMARY KEY,
+            source      TEXT NOT NULL,
+            path        TEXT NOT NULL,
+            mtime       INT,
+            size        INT,
+            hash        TEXT,
+            UNIQUE (source, path)
+        );
         """
-    _COLUMNS = ["name", "type", "file", "extra", "location", "prio", "subprio"]
+    # directory listings of the last scan, see scanner.FileIndex.listings
+    _DIRS_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS zem_dirs (
+            source      TEXT NOT NULL,
+            path        TEXT NOT NULL,
+            mtime       INT NOT NULL,
+            entries     TEXT NOT NULL,
+            PRIMARY KEY (source, path)
+        ) WITHOUT ROWID;
+        """
+    _NAME_INDEX_SCHEMA = """
+        DROP TABLE IF EXISTS zem_gram;
+        DROP TABLE IF EXISTS zem_gram_count;
 
-    def __init__(self, location):
-        self.THREAD_WORKER_NAME = f"DB Worker {location}"
+        CREATE TABLE zem_gram (
+            gram        TEXT NOT NULL,
+            id          INTEGER NOT NULL,
+            PRIMARY KEY (gram, id)
+        ) WITHOUT ROWID;
+        CREATE TABLE zem_gram_count (
+            gram        TEXT PRIMARY KEY,
+            cnt         INT NOT NULL
+        );
+        """
+    # Order of results. zem_rank stores it, so that queries walk the index in
+    # this order and stop after `limit` matches instead of sorting all of them.
+    _ORDER = """
+                prio DESC,
+                length(name) ASC,
+                subprio DESC,
+                name ASC,
+                type ASC,
+                length(file) ASC"""
+    _ROW_COLUMNS = ["name", "type", "file", "extra", "location", "prio", "subprio"]
+    _COLUMNS = _ROW_COLUMNS + ["file_id"]
+    # Results carry their rowid, which breaks ties in their order, so that
+    # get_page can continue after any of them.
+    _RESULT_COLUMNS = _ROW_COLUMNS + ["rowid"]
+    _RESULT_ORDER = (
+        _ORDER
+        + """,
+                rowid ASC"""
+    )
+    # zem_rank's key with rowid, each with the comparison that is true for the
+    # values of rows ranked after a given one
+    _KEY = (
+        ("prio", "<"),
+        ("length(name)", ">"),
+        ("subprio", "<"),
+        ("name", ">"),
+        ("type", ">"),
+        ("length(file)", ">"),
+        ("rowid", ">"),
+    )
+
+    # Only narrow by the name index if the rarest character of the query is
+    # in less than this fraction of all rows, otherwise scanning is cheaper.
+    NAME_INDEX_MAX_FRACTION = 0.1
+
+    def __init__(self, location, *, name_index=False, writer=False, cache=None):
+        self.THREAD_WORKER_NAME = "DB {} {}".format(
+            "Writer" if writer else "Reader", location
+        )
         self.THREAD_WORKER_DAEMON = True
         super().__init__()
         self.location = location
+        self.name_index = name_index
+        self.cache = cache
         self._size = None
+        self._in_update = False
+        self._files = {}  # source -> files, see _source_files
         self.logger = logging.getLogger(f"{__name__}.{self.__class__.__qualname__}")
 
-        self._check_and_init()
+        self._connect(writer)
 
     @TWMI.sync_call
-    def _check_and_init(self):
-        self.con = sqlite3.connect(self.location)
+    def _connect(self, writer):
+        if writer or self.location == ":memory:":
+            self.con = sqlite3.connect(self.location)
+        else:
+            uri = "file:{}?mode=ro".format(urllib.request.pathname2url(self.location))
+            self.con = sqlite3.connect(uri, uri=True)
         self.con.row_factory = sqlite3.Row
+        # abort queries of get_async calls that were superseded by newer ones
+        self.con.set_progress_handler(self._thread_worker.is_stale, 1000)
+        if writer:
+            self._check_and_init()
+
+    def _check_and_init(self):
+        if self.location != ":memory:":
+            # Readers keep seeing the last commit while the writer works
+            self.con.execute("PRAGMA journal_mode=WAL")
 
         try:
-            r = self.con.execute("SELECT * FROM zem LIMIT 1").fetchone()
-            ok = False
-            if r:
-                ok = r.keys() == self._COLUMNS
+            r = self.con.execute("PRAGMA table_info(zem)").fetchall()
+            ok = [c["name"] for c in r] == self._COLUMNS
         except sqlite3.DatabaseError:
             ok = False
         if not ok:
             with self.con as c:
                 c.executescript(self._SCHEMA)
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS zem_rank ON zem({})".format(self._ORDER)
+        )
+        # LIKE ignores case, so only a NOCASE index serves 'prefix%' patterns
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS zem_name ON zem(name COLLATE NOCASE)"
+        )
+        self.con.execute(self._DIRS_SCHEMA)
+
+        has_name_index = bool(
+            self.con.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='zem_gram'"
+            ).fetchone()
+        )
+        if self.name_index and not has_name_index:
+            with self.con as c:
+                c.executescript(self._NAME_INDEX_SCHEMA)
+                self._index_names(c, c.execute("SELECT rowid, name FROM zem"))
+        elif has_name_index and not self.name_index:
+            with self.con as c:
+                c.execute("DROP TABLE zem_gram")
+                c.execute("DROP TABLE zem_gram_count")
 
     @TWMI.sync_call
     def get_size(self):
@@ -68,12 +235,47 @@ class DB(TWMI):
         ).fetchall()
         return r
 
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Commit at the end, unless part of begin_update()/commit_update()."""
+        if self._in_update:
+            yield self.con
+        else:
+            with self.con as con:
+                yield con
+
+    @TWMI.sync_call
+    def begin_update(self):
+        if self._in_update:
+            raise RuntimeError("an update is in progress already")
+        self.con.execute("BEGIN")
+        self._in_update = True
+
+    @TWMI.sync_call
+    def commit_update(self):
+        self._in_update = False
+        self.con.commit()
+        self.con.execute("ANALYZE zem")
+
+    @TWMI.sync_call
+    def rollback_update(self):
+        self._in_update = False
+        self._files.clear()
+        self.con.rollback()
+
     @TWMI.sync_call
     def fill(self, datas, wipe=True):
         self._size = None
-        with self.con as con:
+        with self._transaction() as con:
             if wipe:
+                self._files.clear()
                 con.execute("DELETE FROM zem")
+                con.execute("DELETE FROM zem_files")
+                con.execute("DELETE FROM zem_dirs")
+                if self.name_index:
+                    con.execute("DELETE FROM zem_gram")
+                    con.execute("DELETE FROM zem_gram_count")
+            last_rowid = con.execute("SELECT max(rowid) FROM zem").fetchone()[0] or 0
             for data in datas:  # can pass several iterators
                 con.executemany(
                     """
@@ -82,28 +284,234 @@ class DB(TWMI):
                     VALUES (?,     ?,    ?,    ?,     ?,        ?,    ?)""",
                     data,
                 )
-            con.commit()
-        con.execute("ANALYZE zem")
+            if self.name_index:
+                self._index_names(
+                    con,
+                    con.execute(
+                        "SELECT rowid, name FROM zem WHERE rowid > ?", (last_rowid,)
+                    ),
+                )
+        if not self._in_update:
+            self.con.execute("ANALYZE zem")
+
+    @TWMI.sync_call
+    def get_file_states(self, source):
+        """Return {path: (mtime, size, hash)} of the files last indexed by source."""
+        return {
+            r["path"]: (r["mtime"], r["size"], r["hash"])
+            for r in self.con.execute(
+                "SELECT path, mtime, size, hash FROM zem_files WHERE source = ?",
+                (source,),
+            )
+        }
+
+    @TWMI.sync_call
+    def get_dir_listings(self, source):
+        """Return {path: (mtime, [(name, kind)])} of source's last scan."""
+        return {
+            r["path"]: (r["mtime"], [tuple(e) for e in json.loads(r["entries"])])
+            for r in self.con.execute(
+                "SELECT path, mtime, entries FROM zem_dirs WHERE source = ?",
+                (source,),
+            )
+        }
+
+    @TWMI.sync_call
+    def add_rows(self, source, index, rows):
+        """Add rows of files that changed since source was last indexed.
+
+        `index` is the `scanner.FileIndex` the scanner records the files it
+        sees in. The old rows of a file are deleted when its first new row
+        arrives, so rows can be streamed in batches while the scanner runs.
+        """
+        self._size = None
+        with self._transaction() as con:
+            ids, replaced = self._source_files(con, source)
+            owner = index.owner
+            data = []
+            for row in rows:
+                path = owner or row[2]
+                if path not in replaced:
+                    self._replace_file(con, source, path, index.seen.get(path), ids)
+                    replaced.add(path)
+                data.append(tuple(row) + (ids[path],))
+
+            last_rowid = con.execute("SELECT max(rowid) FROM zem").fetchone()[0] or 0
+            con.executemany(
+                """
+                INSERT INTO zem
+                        (name, type, file, extra, location, prio, subprio, file_id)
+                VALUES (?,     ?,    ?,    ?,     ?,        ?,    ?,       ?)""",
+                data,
+            )
+            if self.name_index:
+                self._index_names(
+                    con,
+                    con.execute(
+                        "SELECT rowid, name FROM zem WHERE rowid > ?", (last_rowid,)
+                    ),
+                )
+
+    @TWMI.sync_call
+    def finish_source(self, source, index, failed=False):
+        """Update the files of source that had no rows, drop the removed ones.
+
+        If the scanner failed, only the files it already delivered rows for are
+        replaced, and they are marked to be scanned again next time.
+        """
+        self._size = None
+        with self._transaction() as con:
+            ids, replaced = self._source_files(con, source)
+            del self._files[source]
+            if failed:
+                con.executemany(
+                    "UPDATE zem_files SET mtime = NULL, hash = NULL WHERE id = ?",
+                    ((ids[p],) for p in replaced),
+                )
+                return
+            for path in index.changed - replaced:
+                self._replace_file(con, source, path, index.seen[path], ids)
+            con.executemany(
+                "UPDATE zem_files SET mtime = ?, size = ?, hash = ? WHERE id = ?",
+                (index.seen[p] + (ids[p],) for p in index.touched if p in ids),
+            )
+            for path in index.removed:
+                if path in ids:
+                    self._delete_rows(con, "file_id = ?", (ids[path],))
+                    con.execute("DELETE FROM zem_files WHERE id = ?", (ids[path],))
+            con.execute("DELETE FROM zem_dirs WHERE source = ?", (source,))
+            con.executemany(
+                "INSERT INTO zem_dirs (source, path, mtime, entries) VALUES (?,?,?,?)",
+                (
+                    (source, path, mtime, json.dumps(entries))
+                    for path, (mtime, entries) in index.listed.items()
+                ),
+            )
+        self.logger.info(
+            "Updated %s: %d changed, %d removed files",
+            source,
+            len(index.changed),
+            len(index.removed),
+        )
+
+    def _source_files(self, con, source):
+        """{path: id} of the files of source and the paths already replaced."""
+        try:
+            return self._files[source]
+        except KeyError:
+            ids = dict(
+                con.execute(
+                    "SELECT path, id FROM zem_files WHERE source = ?", (source,)
+                ).fetchall()
+            )
+            self._files[source] = ids, set()
+            return self._files[source]
+
+    def _replace_file(self, con, source, path, state, ids):
+        """Delete the rows of a file and record its new state."""
+        if path in ids:
+            self._delete_rows(con, "file_id = ?", (ids[path],))
+            con.execute("DELETE FROM zem_files WHERE id = ?", (ids[path],))
+        mtime, size, hash = state or (None, None, None)
+        ids[path] = con.execute(
+            """
+            INSERT INTO zem_files
+                    (source, path, mtime, size, hash)
+            VALUES  (?,      ?,    ?,     ?,    ?)""",
+            (source, path, mtime, size, hash),
+        ).lastrowid
+
+    @TWMI.sync_call
+    def retain_sources(self, sources):
+        """Delete all rows that do not belong to one of sources."""
+        self._size = None
+        sources = list(sources)
+        marks = ",".join("?" * len(sources))
+        with self._transaction() as con:
+            self._delete_rows(
+                con,
+                """file_id IS NULL OR file_id IN (
+                    SELECT id FROM zem_files WHERE source NOT IN ({}))""".format(marks),
+                sources,
+            )
+            con.execute(
+                "DELETE FROM zem_files WHERE source NOT IN ({})".format(marks), sources
+            )
+            con.execute(
+                "DELETE FROM zem_dirs WHERE source NOT IN ({})".format(marks), sources
+            )
+
+    def _delete_rows(self, con, where, params):
+        if self.name_index:
+            self._unindex_names(
+                con,
+                con.execute(
+                    "SELECT rowid, name FROM zem WHERE {}".format(where), params
+                ),
+            )
+        con.execute("DELETE FROM zem WHERE {}".format(where), params)
+
+    @staticmethod
+    def _grams(text):
+        """Characters that any row matched by a LIKE pattern must contain.
+
+        Folded the same way for names and queries, so that characters LIKE
+        treats as equal (ASCII case) end up as the same gram.
+        """
+        return set(text.lower())
+
+    def _index_names(self, con, rows):
+        """Add the rows' names to the character posting lists."""
+        counts = {}
+        postings = []
+        for rowid, name in rows:
+            for g in self._grams(name):
+                postings.append((g, rowid))
+                counts[g] = counts.get(g, 0) + 1
+        con.executemany("INSERT INTO zem_gram (gram, id) VALUES (?, ?)", postings)
+        con.executemany(
+            """
+            INSERT INTO zem_gram_count (gram, cnt) VALUES (?, ?)
+            ON CONFLICT (gram) DO UPDATE SET cnt = cnt + excluded.cnt""",
+            counts.items(),
+        )
+
+    def _unindex_names(self, con, rows):
+        """Remove the rows' names from the character posting lists."""
+        counts = {}
+        postings = []
+        for rowid, name in rows:
+            for g in self._grams(name):
+                postings.append((g, rowid))
+                counts[g] = counts.get(g, 0) + 1
+        con.executemany("DELETE FROM zem_gram WHERE gram = ? AND id = ?", postings)
+        con.executemany(
+            "UPDATE zem_gram_count SET cnt = cnt - ? WHERE gram = ?",
+            ((c, g) for g, c in counts.items()),
+        )
 
     @TWMI.sync_call
     def get(self, tokens, limit=None):
         where, params = self._tokens_to_where_clause(tokens)
+
+        cache = self.cache
+        if cache is not None:
+            generation = cache.generation
+            candidates = cache.lookup(tokens)
+            if candidates is not None:
+                where = "rowid IN (SELECT value FROM json_each(?)) AND " + where
+                params = [json.dumps(candidates)] + params
+
         q = """
             SELECT
-                *
+                {}
             FROM
                 zem
             WHERE
                 {}
-            ORDER BY
-                prio DESC,
-                length(name) ASC,
-                subprio DESC,
-                name  ASC,
-                type ASC,
-                length(file) ASC
+            ORDER BY {}
             """.format(
-            where
+            ", ".join(self._RESULT_COLUMNS), where, self._RESULT_ORDER
         )
         if limit:
             q += """
@@ -113,21 +521,29 @@ class DB(TWMI):
 
         self.logger.debug("Get where %s, %r", where, params)
 
+        t = time.perf_counter()
         try:
-            t = time.time()
             result = self.con.execute(q, params).fetchall()
         except sqlite3.OperationalError:
-            t = time.time() - t
+            t = time.perf_counter() - t
             self.logger.debug("Interrupted after %.2fms", t * 1000)
             raise
 
-        t = t - time.time()
+        t = time.perf_counter() - t
 
         self.logger.debug("%d results in %.2fms", len(result), t * 1000)
+
+        # Only if the limit was not reached, the result has all matches. Reading
+        # more of them just for the cache would cost every query the walk over
+        # zem_rank that the limit saves.
+        if cache is not None and (not limit or len(result) < limit):
+            if len(result) <= cache.MAX_ROWS:
+                cache.store(tokens, [r["rowid"] for r in result], generation)
         return result
 
-    @TWMI.async_call
+    @TWMI.coalescing_call("get_async")
     def get_async(self, tokens, callback, *, limit=None):
+        """Query in the background, superseding the previous get_async."""
         self.logger.debug("get_async %r", tokens)
         try:
             result = self.get(tokens, limit)
@@ -135,6 +551,115 @@ class DB(TWMI):
         except sqlite3.OperationalError:
             pass
 
+    @TWMI.sync_call
+    def get_page(self, tokens, after, limit):
+        """The limit rows ranked right after the row after, like get returns.
+
+        Seeks in zem_rank instead of skipping the rows before with OFFSET. A
+        single comparison of the whole key cannot, as its columns are ordered
+        in different directions, so the rows that equal after in the first i
+        columns and are ranked after it in the next one are queried for
+        decreasing i, until there are enough.
+        """
+        where, params = self._tokens_to_where_clause(tokens)
+        key = (
+            after["prio"],
+            len(after["name"]),
+            after["subprio"],
+            after["name"],
+            after["type"],
+            len(after["file"]),
+            after["rowid"],
+        )
+        result = []
+        for i in reversed(range(len(self._KEY))):
+            seek = ["{} = ?".format(column) for column, _ in self._KEY[:i]]
+            seek.append("{} {} ?".format(*self._KEY[i]))
+            q = """
+                SELECT
+                    {}
+                FROM
+                    zem INDEXED BY zem_rank
+                WHERE
+                    {} AND {}
+                ORDER BY {}
+                LIMIT {:d}
+                """.format(
+                ", ".join(self._RESULT_COLUMNS),
+                " AND ".join(seek),
+                where,
+                self._RESULT_ORDER,
+                limit - len(result),
+            )
+            result += self.con.execute(q, list(key[: i + 1]) + params).fetchall()
+            if len(result) >= limit:
+                break
+        self.logger.debug("%d more results after %r", len(result), key)
+        return result
+
+    @TWMI.coalescing_call("get_page_async")
+    def get_page_async(self, tokens, after, callback, *, limit):
+        """get_page in the background, superseding the previous call."""
+        try:
+            result = self.get_page(tokens, after, limit)
+        except sqlite3.OperationalError:
+            return
+        callback(tokens=tokens, result=result)
+
+    @TWMI.sync_call
+    def get_prefix(self, tokens, limit):
+        """Some of the rows get would return, found quickly by a name prefix.
+
+        Only the rows whose name starts with the literal part of the first name
+        token are considered. They are read in the order of zem_name until
+        limit of them match and then ranked, so the result is no more than a
+        preview of get. Returns None if there is no such prefix or get is
+        quick anyway because the candidates are cached.
+        """
+        prefix = None
+        for typ, val in tokens:
+            if typ.attribute == "name" and typ.grouping == "and":
+                prefix = re.split("[%_]", val, maxsplit=1)[0]  # LIKE wildcards
+                break
+        if not prefix:
+            return None
+        if self.cache is not None and self.cache.lookup(tokens) is not None:
+            return None
+
+        where, params = self._tokens_to_where_clause(tokens)
+        columns = ", ".join(self._RESULT_COLUMNS)
+        q = """
+            SELECT
+                {}
+            FROM (
+                SELECT
+                    {}
+                FROM
+                    zem INDEXED BY zem_name
+                WHERE
+                    name LIKE ? AND {}
+                LIMIT {:d}
+            )
+            ORDER BY {}
+            """.format(
+            columns, columns, where, limit, self._RESULT_ORDER
+        )
+        t = time.perf_counter()
+        result = self.con.execute(q, [prefix + "%"] + params).fetchall()
+        t = time.perf_counter() - t
+        self.logger.debug("%d prefix results in %.2fms", len(result), t * 1000)
+        return result
+
+    @TWMI.coalescing_call("get_prefix_async")
+    def get_prefix_async(self, tokens, callback, *, limit):
+        """get_prefix in the background, superseding the previous call."""
+        try:
+            result = self.get_prefix(tokens, limit)
+        except sqlite3.OperationalError:
+            return
+        if result:
+            callback(tokens=tokens, result=result)
+
     @TWMI.sync_call
     def get_types(self):
         q = """
@@ -147,11 +672,49 @@ class DB(TWMI):
             """
         return [r["type"] for r in self.con.execute(q)]
 
+    def _name_index_clause(self, tokens):
+        """Narrow the candidate rows using the character posting lists.
+
+        Every name token is a LIKE pattern, so a matching name contains each of
+        its literal characters. Intersect the posting lists of the two rarest
+        ones if they are selective enough.
+        """
+        grams = set()
+        for typ, val in tokens:
+            if typ.attribute == "name" and typ.grouping == "and":
+                # _ and % are LIKE wildcards and need not be in the name
+                grams |= self._grams(val) - {"_", "%"}
+        if not grams:
+            return None, []
+
+        counts = dict(
+            self.con.execute(
+                "SELECT gram, cnt FROM zem_gram_count WHERE gram IN ({})".format(
+                    ",".join("?" * len(grams))
+                ),
+                list(grams),
+            ).fetchall()
+        )
+        rarest = sorted(grams, key=lambda g: counts.get(g, 0))[:2]
+        limit = self.get_size() * self.NAME_INDEX_MAX_FRACTION
+        if counts.get(rarest[0], 0) > limit:
+            return None, []
+
+        sub = " INTERSECT ".join(
+            ["SELECT id FROM zem_gram WHERE gram = ?"] * len(rarest)
+        )
+        return "rowid IN ({})".format(sub), rarest
+
     def _tokens_to_where_clause(self, tokens):
         and_clauses = []
         and_params = []
         or_clauses = []
         or_params = []
+        if self.name_index:
+            clause, params = self._name_index_clause(tokens)
+            if clause:
+                and_clauses.append(clause)
+                and_params.extend(params)
         for typ, val in tokens:
             pos, key, match_type, column, op = typ
 
@@ -187,11 +750,132 @@ class DB(TWMI):
         self.stop_thredworker()
 
     def interrupt(self):
-        i = 0
+        """Drop pending get_async calls and abort the running one."""
+        self._thread_worker.cancel("get_async")
+        self.logger.debug("get_async interrupted")
+
+
+class DB:
+    """Index database.
+
+    Writes go through their own connection and worker, so queries keep
+    getting answered from the last committed index while it is updated.
+    An update between `begin_update` and `commit_update` is one transaction
+    and becomes visible to queries atomically at the commit.
+
+    Queries run on a pool of read-only connections, each with its own worker.
+    The first one serves `get_async` for the interactive prompt, the others
+    the synchronous calls, so they do not wait behind each other.
+    """
+
+    def __init__(self, location, *, name_index=False, readers=3):
+        self.location = location
+        self.name_index = name_index
+        self._cache = _CandidateCache()
+        self._writer = _Connection(location, name_index=name_index, writer=True)
+        if location == ":memory:":
+            # every connection would get its own memory database
+            self._writer.cache = self._cache
+            self._readers = [self._writer]
+        else:
+            self._readers = [
+                _Connection(location, name_index=name_index, cache=self._cache)
+                for _ in range(max(readers, 1))
+            ]
+        self._idle = queue.Queue()
+        for r in self._readers[1:] or self._readers:
+            self._idle.put(r)
+
+    @contextlib.contextmanager
+    def _reader(self):
+        """Check out an idle reader for a synchronous call."""
+        r = self._idle.get()
         try:
-            self._thread_worker._q.get_nowait()
-            i += 1
-        except queue.Empty:
-            pass
-        self.con.interrupt()
-        self.logger.debug(f" db interrupted, cleared {i} jobs from Q")
+            yield r
+        finally:
+            self._idle.put(r)
+
+    def get(self, tokens, limit=None):
+        with self._reader() as r:
+            return r.get(tokens, limit)
+
+    def get_async(self, tokens, callback, *, limit=None):
+        self._readers[0].get_async(tokens, callback, limit=limit)
+
+    def get_page(self, tokens, after, limit):
+        with self._reader() as r:
+            return r.get_page(tokens, after, limit)
+
+    def get_page_async(self, tokens, after, callback, *, limit):
+        """Fetch the next page of the prompt's matches, see _Connection.get_page."""
+        self._readers[0].get_page_async(tokens, after, callback, limit=limit)
+
+    def get_prefix_async(self, tokens, callback, *, limit):
+        """Preview the result of get_async, see _Connection.get_prefix.
+
+        Runs on the last reader, so that it does not wait for get_async.
+        """
+        self._readers[-1].get_prefix_async(tokens, callback, limit=limit)
+
+    def get_size(self):
+        with self._reader() as r:
+            return r.get_size()
+
+    def get_stat(self):
+        with self._reader() as r:
+            return r.get_stat()
+
+    def get_types(self):
+        with self._reader() as r:
+            return r.get_types()
+
+    def get_file_states(self, source):
+        with self._reader() as r:
+            return r.get_file_states(source)
+
+    def get_dir_listings(self, source):
+        with self._reader() as r:
+            return r.get_dir_listings(source)
+
+    def fill(self, datas, wipe=True):
+        self._writer.fill(datas, wipe)
+        self._changed()
+
+    def begin_update(self):
+        self._writer.begin_update()
+
+    def add_rows(self, source, index, rows):
+        self._writer.add_rows(source, index, rows)
+
+    def finish_source(self, source, index, failed=False):
+        self._writer.finish_source(source, index, failed)
+
+    def update_source(self, source, index, data):
+        """Replace the rows of a source's changed files with data."""
+        self.add_rows(source, index, data)
+        self.finish_source(source, index)
+
+    def retain_sources(self, sources):
+        self._writer.retain_sources(list(sources))
+
+    def commit_update(self):
+        self._writer.commit_update()
+        self._changed()
+
+    def rollback_update(self):
+        self._writer.rollback_update()
+
+    def _changed(self):
+        self._cache.invalidate()
+        for r in self._readers:
+            r._size = None
+
+    def interrupt(self):
+        """Interrupt the prompt's query."""
+        self._readers[0].interrupt()
+
+    def close(self):
+        for r in self._readers:
+            if r is not self._writer:
+                r.close()
+        self._writer.close()
@@ -1,3 +1,5 @@
+import itertools
+import json
 import logging
 import os
 import pathlib
@@ -25,6 +27,7 @@ Query Syntax:
 Special Keys:
     <ESC>       Stop ZEM, don't change location
     <UP>/<DOWN> Change selected match
+                <UP> on the topmost match loads the next ones
     <CR>        Open the selected match
     <TAB>/<C-P> Open the selected match in a new Tab / PreviewWindow
     <C-U>       ReBuild the Database
@@ -56,6 +59,130 @@ def thread_excepthook(typ, val, tb, thr):
 threading.excepthook = thread_excepthook
 
 
+def diff_lines(old, new):
+    """Return (start, end, lines) so that old[start:end] = lines makes new."""
+    n = min(len(old), len(new))
+    start = 0
+    while start < n and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < n - start and old[-1 - end] == new[-1 - end]:
+        end += 1
+    return start, len(old) - end, new[start : len(new) - end]
+
+
+class QueryScheduler:
+    """Decides when the queries typed into the prompt are sent to the database.
+
+    `send(tokens)` starts a query and `done(tokens)` is called when its result
+    arrives, which measures the latency. While queries are fast, each one is
+    sent right away. Otherwise at most one is in flight, and the latest query
+    typed meanwhile waits for it. If queries are slow, they are also held back
+    until typing pauses for a moment, so a burst of keys starts one query.
+    A query that did not come back after LOST seconds is given up, so a failed
+    one does not hold back the next.
+    """
+
+    FAST = 0.03  # seconds, faster queries are sent right away
+    SLOW = 0.2  # slower queries are debounced
+    MAX_DELAY = 0.15
+    SMOOTHING = 0.3  # weight of the latest latency in the average
+    LOST = 5.0  # a query in flight for this long will not come back
+
+    def __init__(self, send=None, clock=time.perf_counter):
+        self.send = send
+        self.clock = clock
+        self.latency = None  # unknown
+        self._lock = threading.Lock()
+        self._in_flight = None  # (tokens, time sent)
+        self._pending = None
+        self._timer = None
+        self._lost_timer = None  # gives up the query in flight
+
+    def reset(self, send):
+        """Forget queries of the last prompt and send the next ones with send."""
+        with self._lock:
+            self._cancel()
+            self._forget_in_flight()
+            self.send = send
+
+    def cancel(self):
+        """Do not send the pending query."""
+        with self._lock:
+            self._cancel()
+            self._forget_in_flight()
+
+    def _cancel(self):
+        self._pending = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _forget_in_flight(self):
+        self._in_flight = None
+        if self._lost_timer is not None:
+            self._lost_timer.cancel()
+            self._lost_timer = None
+
+    def submit(self, tokens):
+        with self._lock:
+            self._pending = tokens
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self.latency is not None and self.latency >= self.SLOW:
+                delay = min(self.latency / 2, self.MAX_DELAY)
+                self._timer = threading.Timer(delay, self._debounced)
+                self._timer.daemon = True
+                self._timer.start()
+            else:
+                self._send_pending()
+
+    def done(self, tokens):
+        with self._lock:
+            if self._in_flight is not None and self._in_flight[0] == tokens:
+                latency = self.clock() - self._in_flight[1]
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += self.SMOOTHING * (latency - self.latency)
+                self._forget_in_flight()
+            if self._timer is None:
+                self._send_pending()
+
+    def _debounced(self):
+        with self._lock:
+            self._timer = None
+            self._send_pending()
+
+    def _lost(self, in_flight):
+        with self._lock:
+            if self._in_flight is not in_flight:
+                return  # came back meanwhile
+            self._forget_in_flight()
+            if self._timer is None:
+                self._send_pending()
+
+    def _send_pending(self):
+        if self._pending is None:
+            return
+        now = self.clock()
+        if (
+            self._in_flight is not None
+            and self.latency is not None
+            and self.latency >= self.FAST
+            and now - self._in_flight[1] < self.LOST
+        ):
+            return  # done() sends it
+        tokens, self._pending = self._pending, None
+        self._forget_in_flight()
+        self._in_flight = tokens, now
+        self._lost_timer = threading.Timer(self.LOST, self._lost, (self._in_flight,))
+        self._lost_timer.daemon = True
+        self._lost_timer.start()
+        self.send(tokens)
+
+
 @neovim.plugin
 class Plugin(object):
     # Keys that cause an Action
@@ -86,6 +213,8 @@ class Plugin(object):
         self.logger.debug("setting LogLevel on zem to {}", log_level)
 
         self._db = None
+        self.scheduler = QueryScheduler()
+        self._updating = threading.Lock()  # held while update_index runs
 
     def on_error(self):
         self.logger.exception("Exception occured")
@@ -101,6 +230,17 @@ class Plugin(object):
     def cmd(self, cmd):
         self.nvim.command(cmd)
 
+    def atomic(self, calls):
+        """Make several API calls in one round trip, return their results.
+
+        calls are [name, args] pairs for nvim_call_atomic.
+        """
+        results, error = self.nvim.api.call_atomic(calls)
+        if error:
+            index, _, message = error
+            raise neovim.NvimError("{} failed: {}".format(calls[index], message))
+        return results
+
     def get_db(self):
         """Lazy get db handle for current cwd/g:zem_db."""
         loc = self.setting("db", ".zem.sqlite")
@@ -114,17 +254,26 @@ class Plugin(object):
             loc = str(loc)
 
 
+        name_index = bool(self.setting("name_index", False))
+
         db = self._db
         if db is not None:
-            if loc == db.location:
+            if loc == db.location and name_index == db.name_index:
                 return db
             db.close()
-        db = self._db = DB(loc)
+        db = self._db = DB(
+            loc, name_index=name_index, readers=self.setting("db_readers", 3)
+        )
         return db
 
-    @neovim.command("ZemUpdateIndex", sync=False)
+    @neovim.command("ZemUpdateIndex", bang=True, sync=False)
     def zem_update_index(self, *args):
-        """Fill the database."""
+        """Fill the database.
+
+        Only files that changed since the last update are scanned again, with
+        a bang the index is rebuilt from scratch.
+        """
+        full = bool(args and args[-1])
         t = time.perf_counter()
 
         def cb(count):
@@ -133,7 +282,8 @@ class Plugin(object):
                 f"echomsg 'Scanned {count} elements in {d:.3f} seconds'\n"
             )
 
-        self.update_index(cb)
+        if not self.update_index(cb, full):
+            self.nvim.out_write("ZEM: an update is running already\n")
 
     @neovim.command("ZemEdit", nargs="1", sync=True)
     def zem_edit(self, args):
@@ -165,37 +315,63 @@ class Plugin(object):
         self.candidates = []
         self._last_triggered_tokens = None
         self._last_fetched_tokens = None
+        self._fetched_final = False
+        self._paging = False  # a page of matches is being fetched
+        self._exhausted = False  # all matches are candidates
         default_text = " ".join(args)
 
-        self.previous_window = self.nvim.current.window
+        self.height = self.setting("height", 25)
+        db = self.get_db()
+        limit = self.result_count = self.setting("result_count", 20)
+        progressive = self.setting("progressive", True)
+
+        def send(tokens):
+            latency = self.scheduler.latency
+            if progressive and (latency is None or latency >= QueryScheduler.FAST):
+                # show the quick prefix matches until the ranking is done
+                db.get_prefix_async(
+                    tokens=tokens, limit=limit, callback=self.fetch_preview_cb
+                )
+            db.get_async(tokens=tokens, limit=limit, callback=self.fetch_matches_cb)
+
+        self.scheduler.reset(send)
 
-        self.cmd("wincmd n")
-        self.zem_window = self.nvim.current.window
-        self.buffer = self.nvim.current.buffer
+        self.previous_window, _, self.zem_window, self.buffer = self.atomic(
+            [
+                ["nvim_get_current_win", []],
+                ["nvim_command", ["wincmd n"]],
+                ["nvim_get_current_win", []],
+                ["nvim_get_current_buf", []],
+            ]
+        )
+        self.rendered_lines = [""]
         try:
             self.buffer.name = "ZEM"
         except neovim.NvimError:
             self.cmd("edit ZEM")
-        self.cmd("setlocal winminheight=1")
-        self.cmd("setlocal buftype=nowrite")  # TODO: buftype=prompt
-        self.cmd("setlocal bufhidden=delete")
-        self.cmd("setlocal noswapfile")
-        self.cmd("setlocal nowrap")
-        self.cmd("setlocal nonumber")
-        self.cmd("setlocal nohlsearch")
-        self.cmd("setlocal nolist")
-        self.cmd("setlocal cursorline")
-        self.cmd("setlocal nocursorcolumn")
-        self.cmd("setlocal scrolloff=0")
-        self.cmd("setlocal filetype=zem_preview")  # TODO: add FT file
-        self.cmd("{}wincmd _".format(self.setting("height", 25)))
-        self.cmd("wincmd J")
-        self.cmd("redraw")
+        commands = [
+            "setlocal winminheight=1",
+            "setlocal buftype=nowrite",  # TODO: buftype=prompt
+            "setlocal bufhidden=delete",
+            "setlocal noswapfile",
+            "setlocal nowrap",
+            "setlocal nonumber",
+            "setlocal nohlsearch",
+            "setlocal nolist",
+            "setlocal cursorline",
+            "setlocal nocursorcolumn",
+            "setlocal scrolloff=0",
+            "setlocal filetype=zem_preview",  # TODO: add FT file
+            "{}wincmd _".format(self.height),
+            "wincmd J",
+            "redraw",
+        ]
         for k, r in self.REMAPED_KEYS.items():
-            self.cmd("cnoremap <buffer> {} {}".format(k, r))
+            commands.append("cnoremap <buffer> {} {}".format(k, r))
         for k, r in self.SPECIAL_KEYS.items():
             # Special keys just type <action>
-            self.cmd("cnoremap <buffer> {} <LT>{}>".format(k, r))
+            commands.append("cnoremap <buffer> {} <LT>{}>".format(k, r))
+        self.atomic([["nvim_command", [c]] for c in commands])
         if not default_text:
             self.set_buffer_lines_with_usage([])
 
@@ -215,6 +391,7 @@ class Plugin(object):
         except neovim.NvimError as e:
             exc = e
         finally:
+            self.scheduler.cancel()
             self.get_db().interrupt()
             self.close_zem_buffer()
             self.nvim.funcs.inputrestore()
@@ -349,31 +526,38 @@ class Plugin(object):
         if tokens == self._last_triggered_tokens:
             self.logger.debug("Ignore Update for %r", tokens)
         else:
-            db = self.get_db()
             self._last_triggered_tokens = tokens
             self.logger.info("Trigger Update: %r", tokens)
             self.set_buffer_lines_with_usage(
                 ["== Fetching ==", tokens_to_string(tokens)]
             )
-            db.interrupt()
-            db.get_async(
-                tokens=tokens,
-                limit=self.setting("result_count", 20),
-                callback=self.fetch_matches_cb,
-            )
+            self.scheduler.submit(tokens)
 
     def fetch_matches_cb(self, result, tokens):
+        self.scheduler.done(tokens)
         self.nvim.async_call(self.update_matches, result, tokens)
 
-    def update_matches(self, matches, tokens):
+    def fetch_preview_cb(self, result, tokens):
+        self.nvim.async_call(self.update_matches, result, tokens, final=False)
+
+    def update_matches(self, matches, tokens, final=True):
         if self.buffer is None:
             return  # the Zem Buffer was closed since the async call to this function was queued
 
+        if not final and (
+            tokens != self._last_triggered_tokens
+            or (tokens == self._last_fetched_tokens and self._fetched_final)
+        ):
+            return  # outdated, or the ranked matches are shown already
+
         self.logger.info("Update matches: %d %r", len(matches), tokens)
 
         matches = tuple(reversed(matches))
 
         self._last_fetched_tokens = tokens
+        self._fetched_final = final
+        self._paging = False
+        self._exhausted = len(matches) < self.result_count
         self.candidates = matches
 
         if not matches:
@@ -388,14 +572,61 @@ class Plugin(object):
             markup = self.setting("format", self.format_match)
             self.set_buffer_lines([markup(r) for r in matches])
 
+    def fetch_page(self):
+        """Fetch the matches ranked after the candidates, to show above them."""
+        tokens = self._last_fetched_tokens
+        if (
+            self._paging
+            or self._exhausted
+            or not self._fetched_final
+            or tokens != self._last_triggered_tokens
+        ):
+            return
+        self._paging = True
+        self.get_db().get_page_async(
+            tokens=tokens,
+            after=self.candidates[0],
+            limit=self.result_count,
+            callback=self.fetch_page_cb,
+        )
+
+    def fetch_page_cb(self, result, tokens):
+        self.nvim.async_call(self.add_page, result, tokens)
+
+    def add_page(self, matches, tokens):
+        if self.buffer is None:
+            return  # the Zem Buffer was closed since the async call to this function was queued
+        if tokens != self._last_fetched_tokens or not self._paging:
+            return  # other matches are shown meanwhile
+
+        self.logger.info("Add page: %d %r", len(matches), tokens)
+        self._paging = False
+        self._exhausted = len(matches) < self.result_count
+        if not matches:
+            return
+
+        matches = tuple(reversed(matches))
+        self.candidates = matches + self.candidates
+        markup = self.setting("format", self.format_match)
+        # select the best of the new matches, right above the previous ones
+        self.set_buffer_lines(
+            [markup(r) for r in matches] + self.rendered_lines, select=len(matches)
+        )
+
     def action(self, action):
         """Perform the action caused by special keys."""
         if action == "up":
-            self.cmd("normal k")
-            self.cmd("redraw")
+            line, _ = self.atomic(
+                [
+                    ["nvim_win_get_cursor", [self.zem_window]],
+                    ["nvim_command", ["normal k"]],
+                    ["nvim_command", ["redraw"]],
+                ]
+            )[0]
+            if line == 1:
+                self.fetch_page()  # up past the worst candidate
         elif action == "down":
-            self.cmd("normal j")
-            self.cmd("redraw")
+            self.atomic([["nvim_command", ["normal j"]], ["nvim_command", ["redraw"]]])
         elif action == "update":
             self.set_buffer_lines(["Updating..."])
 
@@ -415,7 +646,8 @@ class Plugin(object):
                 self._last_triggered_tokens = None
                 self._last_fetched_tokens = None
 
-            self.update_index(cb)
+            if not self.update_index(cb):
+                self.set_buffer_lines(["An update is running already"])
 
         elif action == "types":
             types = self.get_db().get_types()
@@ -459,15 +691,38 @@ class Plugin(object):
         except neovim.NvimError:
             pass  # something like ATTENTION, swapfile or so..
 
-    def set_buffer_lines(self, lines):
+    def set_buffer_lines(self, lines, select=None):
+        """Show lines in the ZEM buffer, in one round trip.
+
+        Only the lines that differ from what is shown are sent. The cursor goes
+        to line select, by default the last one.
+        """
         if not self.buffer:
             return  # raise TypeError("Setting buffer Lines when buffer is closed")
-        if not self.nvim.current.buffer == self.buffer:
-            return  # raise TypeError("Setting buffer Lines but not in ZEM Buffer")
-        self.buffer[:] = lines
-        self.cmd("{}wincmd _".format(min(len(lines), self.setting("height", 25))))
-        self.cmd("normal Gzb")  # select first result, scroll it to bottom
-        self.cmd("redraw")
+        lines = list(lines) or [""]  # a buffer always has a line
+        start, end, changed = diff_lines(self.rendered_lines, lines)
+        calls = []
+        if changed or start != end:
+            calls.append(
+                ["nvim_buf_set_lines", [self.buffer, start, end, False, changed]]
+            )
+        # only resize and scroll while the ZEM buffer is current
+        # select first result, scroll it to bottom
+        calls.append(
+            [
+                "nvim_command",
+                [
+                    "if bufnr('%') == {} | {}wincmd _ | execute 'normal {}Gzb' | "
+                    "redraw | endif".format(
+                        self.buffer.number,
+                        min(len(lines), self.height),
+                        select or "",
+                    )
+                ],
+            ]
+        )
+        self.atomic(calls)
+        self.rendered_lines = lines
 
     def set_buffer_lines_with_usage(self, lines):
         db = self.get_db()
@@ -476,7 +731,22 @@ class Plugin(object):
         )
         self.set_buffer_lines(lines)
 
-    def update_index(self, callback):
+    def update_index(self, callback, full=False):
+        """Update the database in the background, then call callback(count).
+
+        Returns False and does nothing if an update is running already.
+        """
+        if not self._updating.acquire(blocking=False):
+            self.logger.info("Update is running already")
+            return False
+        try:
+            self._start_update(callback, full)
+        except BaseException:
+            self._updating.release()
+            raise
+        return True
+
+    def _start_update(self, callback, full):
         self.logger.debug("Starting update")
         # Make paths in scanners relative to buffer's cwd
         os.chdir(self.nvim.funcs.getcwd())
@@ -488,49 +758,112 @@ class Plugin(object):
             base_param.update(param)
             func = getattr(scanner, source)
             name = base_param.get("name") or base_param.get('file') or base_param.get('root') or source
-            jobs.append((job_number, name,func, base_param))
+            # rows of a source are only reused while its settings stay the same
+            key = "{}:{}:{}".format(source, name, json.dumps(base_param, sort_keys=True))
+            jobs.append((job_number, name, func, base_param, key))
+
+        # Sources that walk the same root share one walk of it
+        roots = {}
+        for number, name, func, param, key in jobs:
+            if func in (scanner.files, scanner.lines, scanner.words):
+                if not param.get("git"):
+                    root = pathlib.Path(param.get("root", ".")).as_posix()
+                    roots.setdefault(root, []).append(number)
+        walks = {}
+        for root, numbers in roots.items():
+            if len(numbers) > 1:
+                walk = scanner.SharedWalk(root, len(numbers))
+                walks.update((number, walk.consumer()) for number in numbers)
 
         db = self.get_db()
 
-        q = queue.SimpleQueue()
+        # Bounded, so scanners block instead of piling up rows while the db
+        # writer is busy.
+        batch_size = self.setting("batch_size", 10000)
+        q = queue.Queue(maxsize=self.setting("queue_size", 8))
+        stopped = threading.Event()  # finish() failed and takes no more batches
 
-        def do_scan(number, name, func, args):
+        def put(item):
+            """q.put(item), False if finish() stopped meanwhile."""
+            while not stopped.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def do_scan(number, name, func, args, key):
             self.logger.debug("Starting Job %d: %s", number, name)
+            index = scanner.FileIndex()
+            count = 0
+            failed = False
+            walk = walks.get(number)
+            rows = None
             try:
-                data = func(args)
-                self.logger.debug("Job %d: %s got %d records", number, name, len(data))
+                if not full:
+                    index = scanner.FileIndex(
+                        db.get_file_states(key), db.get_dir_listings(key)
+                    )
+                rows = func(args, index, walk) if walk else func(args, index)
+                while True:
+                    batch = list(itertools.islice(rows, batch_size))
+                    if not batch:
+                        break
+                    count += len(batch)
+                    if not put((number, name, key, index, batch, False)):
+                        self.logger.debug("Job %d: %s stopped", number, name)
+                        return
+                self.logger.debug("Job %d: %s got %d records", number, name, count)
             except BaseException:
-                self.logger.exception("Job %d: %s got an Exception", number, name, len(data))
+                self.logger.exception("Job %d: %s got an Exception", number, name)
                 self.on_error()
-                data = []
-            q.put((number, name, data))
+                failed = True
+            finally:
+                if hasattr(rows, "close"):
+                    rows.close()  # e.g. kill ctags
+                if walk:
+                    walk.close()
+            put((number, name, key, index, None, failed))
 
 
-        for number, name, func, arg in jobs:
+        for number, name, func, arg, key in jobs:
             self.logger.debug("Starting thread for job %d: %s", number, name)
             t = threading.Thread(
-                    target=do_scan, name=f"scan {number} {name}", args=(number, name, func, arg)
+                    target=do_scan, name=f"scan {number} {name}", args=(number, name, func, arg, key)
             )
             t.start()
 
         def finish():
+            begun = False
             try:
-                datas = []
                 missing = set(range(len(jobs)))
                 count = 0
-                while missing:
-                    self.logger.debug("Waiting on jobs %r", missing)
-                    number, name, data = q.get()
-                    missing.remove(number)
-                    count += len(data)
-                    datas.append(data)
-                    self.logger.debug("Recived %d records from %d:%s", len(data), number, name)
                 t = time.perf_counter()
-                db.fill(datas)
+                db.begin_update()
+                begun = True
+                if full:
+                    db.fill([])
+                while missing:
+                    number, name, key, index, batch, failed = q.get()
+                    if batch is None:
+                        missing.remove(number)
+                        self.logger.debug("Job %d:%s done, waiting on %r", number, name, missing)
+                        db.finish_source(key, index, failed)
+                    else:
+                        count += len(batch)
+                        db.add_rows(key, index, batch)
+                db.retain_sources(key for *_, key in jobs)
+                db.commit_update()
                 t = time.perf_counter() - t
                 self.logger.info(f"Putting {count} records in the db took {t:.3f}s")
                 self.nvim.async_call(callback, count)
-            except BaseException as e:
-                self.on_error(e)
+            except BaseException:
+                stopped.set()  # let the scanners leave q.put
+                if begun:
+                    db.rollback_update()
+                self.on_error()
+            finally:
+                self._updating.release()
 
         threading.Thread(target=finish).start()
@@ -1,4 +1,5 @@
 import collections
+import string
 
 TokenTyp = collections.namedtuple("TokenTyp", "pos key matchtyp attribute grouping ")
 
@@ -52,3 +53,45 @@ def tokenize(text, *, ignore=("options")):
 
 def tokens_to_string(tokens):
     return " ".join(tt.key + t for (tt, t) in tokens)
+
+
+# LIKE ignores the case of ASCII letters only
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def _implies(matchtyp, val, previous):
+    """Whether everything val matches is also matched by previous."""
+    val = val.translate(_ASCII_LOWER)
+    previous = previous.translate(_ASCII_LOWER)
+    if matchtyp == "fuzzy":
+        rest = iter(val)
+        return all(c in rest for c in previous)  # previous is a subsequence
+    elif matchtyp == "prefix":
+        return val.startswith(previous)
+    else:
+        return val == previous
+
+
+def refines(tokens, previous):
+    """Whether all matches of tokens are also matches of previous.
+
+    True if tokens only add to or extend the tokens of previous, e.g. when
+    the user typed another character.
+    """
+    for tt, val in previous:
+        if tt.grouping == "and":
+            if not any(t == tt and _implies(tt.matchtyp, v, val) for t, v in tokens):
+                return False
+
+    # each alternative of tokens has to be implied by one of previous
+    previous_or = [(tt, val) for tt, val in previous if tt.grouping == "or"]
+    if previous_or:
+        tokens_or = [(tt, val) for tt, val in tokens if tt.grouping == "or"]
+        if not tokens_or:
+            return False
+        for tt, val in tokens_or:
+            if not any(
+                t == tt and _implies(tt.matchtyp, val, v) for t, v in previous_or
+            ):
+                return False
+    return True
@@ -1,13 +1,93 @@
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import heapq
 import io
+import itertools
 import logging
+import mmap
+import multiprocessing
+import os
 import pathlib
+import queue
 import re
+import shlex
 import subprocess
+import threading
 import time
 
 _logger = logging.getLogger(__name__)
 
 
+class FileIndex:
+    """The files a source saw during a scan, compared to the previous scan.
+
+    Scanners call `check` for every file they see and only produce rows for
+    the files it returns True for. Rows belong to the file they are in, or to
+    `owner` if set (e.g. the tags file they were parsed from).
+    """
+
+    def __init__(self, known=None, listings=None):
+        self.known = known or {}  # path -> (mtime, size, hash) of the last scan
+        self.seen = {}
+        self.changed = set()
+        self.touched = set()  # new state, but same contents: keep the rows
+        self.owner = None
+        # directory -> (mtime, [(name, kind)]) of the last and this scan
+        self.listings = listings or {}
+        self.listed = {}
+
+    def check(self, path, st=None, hash=None):
+        """Record path with its stat result and return if it needs scanning.
+
+        Without st, only added files need scanning.
+        """
+        if st is None:
+            state = (0, 0, hash)
+        else:
+            state = (st.st_mtime_ns, st.st_size, hash)
+        self.seen[path] = state
+        if self.known.get(path) == state:
+            return False
+        self.changed.add(path)
+        return True
+
+    def check_contents(self, path, st, hash_file):
+        """Like check, but compare the hash_file(path) of a file whose stat changed.
+
+        If the contents are the same as last time, path is only touched.
+        """
+        known = self.known.get(path)
+        if known is not None and known[:2] == (st.st_mtime_ns, st.st_size):
+            self.seen[path] = known
+            return False
+        hash = hash_file(path)
+        if known is not None and known[2] == hash:
+            self.seen[path] = (st.st_mtime_ns, st.st_size, hash)
+            self.touched.add(path)
+            return False
+        return self.check(path, st, hash)
+
+    def add(self, path):
+        """Record path as changed without knowing its state."""
+        self.seen[path] = (None, None, None)
+        self.changed.add(path)
+
+    @property
+    def removed(self):
+        return self.known.keys() - self.seen.keys()
+
+
+def _hash_file(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
 def _translate(lines, parent=""):
     """Translate exclude pattenrs like .gitignore to regex."""
     result = []
@@ -70,48 +150,699 @@ def _translate(lines, parent=""):
     return result
 
 
-def _file_walk(root, exclude, exclude_files):
+_ESCAPED_LITERAL = re.compile(r"(?:\\.|[^\\.^$*+?{}\[\]()|])*")
+
+
+def _unescape(pattern):
+    """The literal string matched by pattern, None if it is not a literal."""
+    if not _ESCAPED_LITERAL.fullmatch(pattern):
+        return None
+    return re.sub(r"\\(.)", r"\1", pattern)
+
+
+class _Matcher:
+    """A stack of exclude rules from _translate, compiled for fast matching.
+
+    The last rule that matches a path decides if it is excluded. Rules are
+    checked from the last one. Consecutive rules are merged into a single
+    regex whose group tells which one matched, while rules like `name` or
+    `*.ext` become substring tests.
+    """
+
+    _REGEX, _COMPONENT, _CONTAINS, _PREFIX = range(4)
+
+    def __init__(self, rules):
+        self.rules = rules
+        self._checks = {}  # isdir -> checks
+
+    def extend(self, rules):
+        if not rules:
+            return self
+        return _Matcher(self.rules + rules)
+
+    @classmethod
+    def _literal_check(cls, pattern, negate):
+        head, wild, tail = pattern.partition("(?:.*/)?")
+        if not wild:
+            head, tail = "", head
+            kind = cls._PREFIX
+        elif tail.startswith("[^/]*"):
+            tail = tail[len("[^/]*") :]
+            kind = cls._CONTAINS
+        else:
+            kind = cls._COMPONENT
+        head = _unescape(head)
+        tail = _unescape(tail)
+        if head is None or not tail:
+            return None
+        if kind == cls._PREFIX:
+            # parent/a/b: the whole pattern is one literal prefix
+            head, tail = "", head + tail
+        return kind, head, tail, negate
+
+    def _compile(self, isdir):
+        checks = []
+        run = []
+
+        def flush():
+            if run:
+                r = re.compile("|".join("({})".format(p) for p, _ in run))
+                checks.append((self._REGEX, r, [n for _, n in run]))
+                run.clear()
+
+        for r, d, n in reversed(self.rules):
+            if d and not isdir:
+                continue
+            check = self._literal_check(r.pattern, n)
+            if check:
+                flush()
+                checks.append(check)
+            else:
+                run.append((r.pattern, n))
+        flush()
+        return checks
+
+    def excluded(self, path, isdir):
+        try:
+            checks = self._checks[isdir]
+        except KeyError:
+            checks = self._checks[isdir] = self._compile(isdir)
+        for kind, *check in checks:
+            if kind == self._REGEX:
+                r, negate = check
+                m = r.match(path)
+                if m:
+                    return not negate[m.lastindex - 1]
+                continue
+            head, lit, negate = check
+            if not path.startswith(head):
+                continue
+            t = path[len(head) :]
+            if kind == self._CONTAINS:
+                matched = lit in t
+            elif kind == self._COMPONENT:
+                matched = t.startswith(lit) or "/" + lit in t
+            else:
+                matched = t.startswith(lit)
+            if matched:
+                return not negate
+        return False
+
+
+class _CachedEntry:
+    """Stands in for the `os.DirEntry` of a listing from `FileIndex.listings`."""
+
+    __slots__ = ("name", "path", "_kind", "_stat")
+
+    def __init__(self, d, name, kind):
+        self.name = name
+        self.path = os.path.join(d, name)
+        self._kind = kind
+        self._stat = None
+
+    def is_dir(self):
+        return self._kind == "d"
+
+    def is_file(self):
+        return self._kind == "f"
+
+    def stat(self):
+        if self._stat is None:  # cached like os.DirEntry.stat()
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+def _list_dir(d, index):
+    """List directory d, reusing the last scan's listing if d did not change.
+
+    A directory's mtime changes when entries are added, removed or renamed in
+    it, but not in its subdirectories, so each one still needs a stat.
+    """
+    if index is None:
+        with os.scandir(d) as it:
+            return list(it)
+    mtime = os.stat(d).st_mtime_ns  # before listing, so changes during it count
+    last = index.listings.get(d)
+    if last is not None and last[0] == mtime:
+        listing = last[1]
+        entries = [_CachedEntry(d, name, kind) for name, kind in listing]
+    else:
+        with os.scandir(d) as it:
+            entries = list(it)
+        listing = [
+            (e.name, "d" if e.is_dir() else "f" if e.is_file() else "")
+            for e in entries
+        ]
+    index.listed[d] = (mtime, listing)
+    return entries
+
+
+def _scan_dir(d, rel, matcher, exclude_files, index, logger):
+    """List the entries of directory d that are not excluded.
+
+    rel is the path of d relative to the root of the walk. Returns the matcher
+    for the subdirectories of d, which includes its ignore files, and a list of
+    (relative path, entry, isdir) in directory order.
+    """
+    try:
+        entries = _list_dir(d, index)
+    except OSError:
+        return matcher, []
+    names = {e.name: e for e in entries}
+    for f in exclude_files:
+        e = names.get(f)
+        if e is not None and e.is_file():
+            logger.debug("add {} to excludes", e.path)
+            with open(e.path, "rt") as f:
+                # subdirectories without own ignore files reuse this one
+                matcher = matcher.extend(_translate(f, rel))
+    result = []
+    for e in entries:
+        s = rel + "/" + e.name if rel else e.name
+        isdir = e.is_dir()
+        if not matcher.excluded(s, isdir) and (isdir or e.is_file()):
+            result.append((s, e, isdir))
+    return matcher, result
+
+
+def _parallel_walk(root, prefix, matcher, exclude_files, workers, index, logger):
+    """Walk root with a pool of threads, yielding (path, entry) in any order.
+
+    Directories that are still to be listed wait on a shared stack. An idle
+    worker takes the one found last, so the walk stays mostly depth first and
+    no worker idles while another one has directories left.
+    """
+    lock = threading.Condition()
+    stack = [(root, "", matcher)]
+    busy = 0
+    stopped = False
+    results = queue.Queue()
+
+    def work():
+        nonlocal busy
+        while True:
+            with lock:
+                while not stack and busy and not stopped:
+                    lock.wait()
+                if stopped or not stack:  # nothing left, and no one busy
+                    lock.notify_all()
+                    break
+                d, rel, m = stack.pop()
+                busy += 1
+            subdirs = []
+            try:
+                m, entries = _scan_dir(d, rel, m, exclude_files, index, logger)
+                batch = []
+                for s, e, isdir in entries:
+                    if isdir:
+                        subdirs.append((e.path, s, m))
+                    else:
+                        batch.append((prefix + s, e))
+                if batch:
+                    results.put(batch)
+            except Exception as e:
+                results.put(e)
+            with lock:
+                stack.extend(reversed(subdirs))
+                busy -= 1
+                lock.notify_all()
+        results.put(None)
+
+    for i in range(workers):
+        threading.Thread(target=work, name=f"zem-walk-{i}", daemon=True).start()
+    try:
+        running = workers
+        while running:
+            item = results.get()
+            if item is None:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield from item
+    finally:
+        with lock:
+            stopped = True
+            lock.notify_all()
+
+
+def _file_walk(root, exclude, exclude_files, workers=1, index=None):
+    """Yield (path, entry) for each file below root that is not excluded.
+
+    path is a posix path starting with root, entry its `os.DirEntry`, or None
+    if root itself is a file. With more than one worker, directories are
+    listed by a pool of threads and the order of the files is undefined.
+    Directory listings are recorded in and reused from the `FileIndex` index.
+    """
     logger = _logger.getChild("_file_walk")
 
-    root = pathlib.Path(root)
+    root = pathlib.Path(root).as_posix()
 
     logger.info("walk {}, exclude {} and from {}", root, exclude, exclude_files)
 
-    excludes = _translate(exclude)
+    excludes = _Matcher(_translate(exclude))
 
-    def walk(d, exclude_stack):
-        if d.is_file():
-            yield d
+    if os.path.isfile(root):
+        yield root, None
+        return
+    prefix = "" if root == "." else root.rstrip("/") + "/"
+
+    if workers > 1:
+        yield from _parallel_walk(
+            root, prefix, excludes, exclude_files, workers, index, logger
+        )
+        return
+
+    def walk(d, rel, matcher):
+        matcher, entries = _scan_dir(d, rel, matcher, exclude_files, index, logger)
+        for s, e, isdir in entries:
+            if isdir:
+                yield from walk(e.path, s, matcher)
+            else:
+                yield prefix + s, e
+
+    yield from walk(root, "", excludes)
+
+
+class SharedWalk:
+    """One walk of a directory tree, shared by the scanners of several sources.
+
+    Each scanner gets a `consumer()` as its `walk` argument and joins with its
+    own exclude patterns and exclude files. It then gets the files it does not
+    exclude, like from _file_walk. Directories are listed, ignore files parsed
+    and the `os.DirEntry` of each file (which caches its stat result) created
+    once for all of them. The walk starts when every consumer joined or was
+    closed without joining.
+
+    Each consumer queues at most MAX_BATCHES batches, so the walk waits for the
+    slowest active consumer instead of holding the whole tree in memory.
+    """
+
+    BATCH_SIZE = 256
+    MAX_BATCHES = 16
+
+    def __init__(self, root, consumers):
+        self.root = pathlib.Path(root).as_posix()
+        self.logger = _logger.getChild("SharedWalk")
+        self._lock = threading.Lock()
+        self._pending = consumers
+        self._joined = []
+
+    def consumer(self):
+        return _WalkConsumer(self)
+
+    def _join(self, consumer):
+        with self._lock:
+            self._joined.append(consumer)
+            self._pending -= 1
+            start = not self._pending
+        if start:
+            threading.Thread(target=self._run, name=f"walk {self.root}").start()
+
+    def _leave(self):
+        self._join(None)
+
+    def _run(self):
+        consumers = [c for c in self._joined if c is not None]
+        try:
+            self._walk(consumers)
+        except Exception as e:
+            self.logger.exception("walk of %s failed", self.root)
+            for c in consumers:
+                c.put(e)
+        else:
+            for c in consumers:
+                c.flush()
+        for c in consumers:
+            c.put(None)
+
+    def _walk(self, consumers):
+        root = self.root
+        self.logger.info("walk %s for %d sources", root, len(consumers))
+        if os.path.isfile(root):
+            for c in consumers:
+                c.add(root, None)
             return
-        for f in exclude_files:
-            p = d / f
-            if p.is_file():
-                logger.debug("add {} to excludes", p)
-                with p.open("rt") as f:
-                    x = _translate(f, d.relative_to(root).as_posix())
-                exclude_stack = exclude_stack + x
-        for p in d.glob("*"):
-            s = p.relative_to(root).as_posix()
-            isdir = p.is_dir()
-            exclude = False
-            for r, d, n in reversed(exclude_stack):
-                if d and not isdir:
-                    continue
-                if r.match(s):
-                    if n:  # explicit include
-                        break
-                    else:
-                        exclude = True
-                        break
-            if not exclude:
-                # implicit include
-                yield from walk(p, exclude_stack)
+        prefix = "" if root == "." else root.rstrip("/") + "/"
+        indexes = [c.index for c in consumers if c.index is not None]
+
+        def walk(d, rel, matchers):
+            if not any(c.active for c in consumers):
+                return
+            try:
+                entries = _list_dir(d, indexes[0] if indexes else None)
+            except OSError:
+                return
+            for index in indexes[1:]:
+                index.listed[d] = indexes[0].listed[d]
+            names = {e.name: e for e in entries}
+            rules = {}  # ignore file -> rules, parsed once for all consumers
+            for i, c in enumerate(consumers):
+                for f in c.exclude_files:
+                    e = names.get(f)
+                    if matchers[i] is None or e is None or not e.is_file():
+                        continue
+                    if f not in rules:
+                        with open(e.path, "rt") as fh:
+                            rules[f] = _translate(fh, rel)
+                    matchers[i] = matchers[i].extend(rules[f])
+            for e in entries:
+                s = rel + "/" + e.name if rel else e.name
+                if e.is_dir():
+                    sub = [
+                        m if m and not m.excluded(s, True) else None for m in matchers
+                    ]
+                    if any(sub):
+                        walk(e.path, s, sub)
+                elif e.is_file():
+                    for c, m in zip(consumers, matchers):
+                        if m and not m.excluded(s, False):
+                            c.add(prefix + s, e)
+
+        walk(root, "", [c.matcher for c in consumers])
+
+
+class _WalkConsumer:
+    """The part of a SharedWalk that one scanner gets, see `join`."""
+
+    def __init__(self, walk):
+        self.walk = walk
+        self.queue = queue.Queue(maxsize=walk.MAX_BATCHES)
+        self.active = True
+        self._batch = []
+        self._joined = False
+
+    def join(self, exclude, exclude_files, index=None):
+        """Yield (path, entry) like `_file_walk(root, exclude, exclude_files)`.
+
+        Directory listings are recorded in index as by _file_walk."""
+        self.matcher = _Matcher(_translate(exclude))
+        self.exclude_files = exclude_files
+        self.index = index
+        self._joined = True
+        self.walk._join(self)
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield from batch
+        finally:
+            self.active = False
+
+    def close(self):
+        """Give up the consumer, whether it joined or not."""
+        self.active = False
+        if not self._joined:
+            self._joined = True
+            self.walk._leave()
+
+    def add(self, path, entry):
+        if self.active:
+            self._batch.append((path, entry))
+            if len(self._batch) >= self.walk.BATCH_SIZE:
+                self.flush()
+
+    def flush(self):
+        if self._batch:
+            self.put(self._batch)
+            self._batch = []
+
+    def put(self, item):
+        """Queue item, unless the consumer stops reading meanwhile."""
+        while self.active:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+def _git(root, *args):
+    """Run a git command in root and return its \0 separated output lines."""
+    p = subprocess.run(
+        ["git", "-C", root, *args, "-z"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    return p.stdout.decode(errors="surrogateescape").split("\0")[:-1]
+
+
+def _git_files(root, exclude):
+    """List the files below root from the git index, None if not possible.
+
+    That is the tracked files that were not deleted, and the untracked ones
+    that git does not ignore. Paths are like those of _file_walk, and the
+    exclude patterns are applied to them. Directories git does not list the
+    files of, like nested repositories, can only be walked, so they give None
+    too.
+    """
+    logger = _logger.getChild("_git_files")
+
+    root = pathlib.Path(root).as_posix()
+    if not os.path.isdir(root):
+        return None
+    try:
+        staged = _git(root, "ls-files", "--stage")
+        deleted = set(_git(root, "ls-files", "--deleted"))
+        untracked = _git(root, "ls-files", "--others", "--exclude-standard")
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.info("no git index in %s: %s", root, e)
+        return None
+
+    tracked = {}  # path -> None, conflicts have one entry per stage
+    links = set()
+    for line in staged:
+        info, _, path = line.partition("\t")
+        if not info.startswith("160000 "):  # submodule
+            tracked[path] = None
+        if info.startswith("120000 "):
+            links.add(path)
+
+    matcher = _Matcher(_translate(exclude))
+    dirs = {"": False}  # dir -> excluded
+
+    def excluded_dir(d):
+        try:
+            return dirs[d]
+        except KeyError:
+            parent = d.rpartition("/")[0]
+            x = dirs[d] = excluded_dir(parent) or matcher.excluded(d, True)
+            return x
+
+    prefix = "" if root == "." else root.rstrip("/") + "/"
+    links.update(untracked)
+    result = []
+    for path in itertools.chain(tracked, untracked):
+        if path in deleted:
+            continue
+        # git lists an untracked repository as dir/ and a link to a directory
+        # as a file, a walk yields the files in them
+        if path.endswith("/") or (path in links and os.path.isdir(prefix + path)):
+            logger.info("%s is a directory in the git index of %s", path, root)
+            return None
+        if excluded_dir(path.rpartition("/")[0]) or matcher.excluded(path, False):
+            continue
+        result.append(prefix + path)
+    logger.info("%d files in the git index of %s", len(result), root)
+    return result
+
+
+def _stat(path, entry):
+    """Stat a file from _file_walk, cached in entry where the OS allows."""
+    if entry is None:
+        return os.stat(path)
+    return entry.stat()
+
+
+def _chunks(iterable, size):
+    """Split iterable into lists of up to size elements."""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _pool_map(processes, func, chunks, *args):
+    """Yield func(chunk, *args) for each chunk, computed by a process pool.
+
+    Results come in the order of chunks. Only a few chunks per process are in
+    flight, so a slow consumer does not pile up results in memory.
+    """
+    # fork is not safe in the multithreaded plugin host
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(processes, context) as pool:
+        pending = collections.deque()
+        try:
+            for chunk in chunks:
+                pending.append(pool.submit(func, chunk, *args))
+                if len(pending) >= 2 * processes:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+
+# files with a NUL byte in the first block are binary and skipped
+_BINARY_PROBE = 8192
+# and if many lines in its start match, it is read as text, which is faster then
+_DENSITY_PROBE = 2048
+
+# anything that matches differently in UTF-8 encoded bytes, or across lines
+_NOT_BYTES_SAFE = re.compile(r"\\[a-zA-Z0-9]|[.^$\n\r]|\[\^")
+
+
+@functools.lru_cache()
+def _line_pattern(r):
+    """r as a bytes regex that finds every line r finds, None if unsure."""
+    if r.flags != re.UNICODE or not r.pattern.isascii():
+        return None
+    if _NOT_BYTES_SAFE.search(r.pattern):
+        return None
+    return re.compile(r.pattern.encode())
+
+
+def _dense(rb, sample):
+    """Whether rb matches in more than a quarter of the lines of sample."""
+    lines = sample.split(b"\n")
+    return 4 * sum(1 for line in lines if rb.search(line)) > len(lines)
+
+
+def _open_contents(f, r):
+    """Decide how to scan the binary file object f for r.
+
+    Returns None for binary files. If few lines at the start of f
+    match, returns f memory mapped, to be searched with _mmap_lines. Otherwise
+    returns False and f is best read as text.
+    """
+    block = f.read(_BINARY_PROBE)
+    if b"\0" in block:
+        return None
+    f.seek(0)
+    rb = _line_pattern(r)
+    if rb is None or _dense(rb, block[:_DENSITY_PROBE]):
+        return False
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:  # empty file
+        return False
+    # text mode also ends lines at a lone \r
+    if mm.find(b"\r") >= 0 and re.search(rb"\r(?!\n)", mm):
+        mm.close()
+        return False
+    return mm
+
+
+def _mmap_lines(mm, r):
+    """Yield (lineno, line) for the lines of mm that might match r.
+
+    Only those lines are decoded, the rest is searched as bytes.
+    """
+    rb = _line_pattern(r)
+    size = len(mm)
+    lineno = 1
+    counted = 0
+    start = 0
+    while True:
+        m = rb.search(mm, start)
+        if m is None:
+            return
+        begin = mm.rfind(b"\n", 0, m.start()) + 1
+        if begin == size:  # an empty match after the last newline
+            return
+        end = mm.find(b"\n", m.start())
+        if end < 0:
+            end = size
+        lineno += mm[counted:begin].count(b"\n")
+        counted = begin
+        yield lineno, mm[begin:end].decode("utf-8", "replace").strip()
+        if end == size:
+            return
+        start = end + 1
+
+
+def _file_lines(path, r):
+    """Yield (line, None, lineno) for the lines of path that match r."""
+    with open(path, "rb") as f:
+        mm = _open_contents(f, r)
+        if mm is None:
+            return
+        if mm is not False:
+            with mm:
+                for lineno, line in _mmap_lines(mm, r):
+                    if r.search(line):
+                        yield line, None, lineno
+            return
+        text = io.TextIOWrapper(f, encoding="utf-8", errors="replace")
+        for i, line in enumerate(text):
+            line = line.strip()
+            if r.search(line):
+                yield line, None, i + 1
+
+
+def _file_words(path, r):
+    """Yield (word, line, lineno) for the matches of r in path."""
+    with open(path, "rb") as f:
+        mm = _open_contents(f, r)
+        if mm is None:
+            return
+        if mm is not False:
+            with mm:
+                for lineno, line in _mmap_lines(mm, r):
+                    for m in r.finditer(line):
+                        yield m.group(0), line, lineno
+            return
+        text = io.TextIOWrapper(f, encoding="utf-8", errors="replace")
+        for i, line in enumerate(text):
+            line = line.strip()
+            for m in r.finditer(line):
+                yield m.group(0), line, i + 1
+
+
+def _scan_chunk(paths, scan, r):
+    """Scan a chunk of files in a worker process.
 
-    yield from walk(root, excludes)
+    Only what differs per element is sent back, the caller adds the rest."""
+    return [(path, list(scan(path, r))) for path in paths]
 
 
-def files(settings={}):
-    """Index the directory Tree."""
+_CHUNK_FILES = 64
+
+
+def _scan_contents(paths, scan, r, processes):
+    """Yield (path, matches) for each of paths, see _file_lines/_file_words."""
+    if processes > 1:
+        chunks = _chunks(paths, _CHUNK_FILES)
+        for result in _pool_map(processes, _scan_chunk, chunks, scan, r):
+            yield from result
+    else:
+        for path in paths:
+            yield path, scan(path, r)
+
+
+FILES_DEFAULT_EXCLUDE = [
+    "*~",
+    ".*/",
+    "*.pyc",
+    "*.o",
+    "*._*",
+    "*.class",
+    "!*.map",
+]
+
+
+def files(settings={}, index=None, walk=None):
+    """Index the directory Tree.
+
+    Like all scanners, a generator that yields one row per element. walk is a
+    `SharedWalk.consumer()` to get the files from instead of walking root."""
 
     logger = _logger.getChild("files")
 
@@ -120,34 +851,44 @@ def files(settings={}):
     subprio = settings.get("subprio", 50)
     prio = settings.get("prio", 99)
     exfiles = settings.get("exclude_files", [".gitignore", ".p4ignore"])
-    exclude = settings.get(
-        "exclude",
-        [
-            "*~",
-            ".*/",
-            "*.pyc",
-            "*.o",
-            "*._*",
-            "*.class",
-            "!*.map",
-        ],
-    )
+    workers = settings.get("workers", 1)
+    exclude = settings.get("exclude", FILES_DEFAULT_EXCLUDE)
 
     root = pathlib.Path(root)
 
     logger.info("Index files in {}", root.absolute().as_posix())
     t = time.perf_counter()
-    files = [
-        (f.name, typ, f.as_posix(), None, None, prio, subprio)
-        for f in _file_walk(root, exclude, exfiles)
-    ]
+    count = 0
+    paths = _git_files(root, exclude) if settings.get("git") else None
+    if paths is None:
+        if walk is not None:
+            walk = walk.join(exclude, exfiles, index)
+        else:
+            walk = _file_walk(root, exclude, exfiles, workers, index)
+        paths = (path for path, _ in walk)
+    for path in paths:
+        if index is None or index.check(path):
+            count += 1
+            yield (path.rpartition("/")[2], typ, path, None, None, prio, subprio)
     t = time.perf_counter() - t
-    logger.info("Indexed {} files in {:.3f}s", len(files), t)
+    logger.info("Indexed {} files in {:.3f}s", count, t)
 
-    return files
 
+def _content_paths(walk, limit, index, logger):
+    """Yield the files from walk whose contents need to be indexed."""
+    for path, entry in walk:
+        st = _stat(path, entry)
+        if index is not None and not index.check(path, st):
+            continue
+        size = st.st_size
+        if size > limit:
+            logger.info("File too large: {} {}b", path, size)
+            continue
+        logger.info("indexing: {}", path)
+        yield path
 
-def lines(settings={}):
+
+def lines(settings={}, index=None, walk=None):
     """Index lines of files.
 
     to only search some files, set exclude to '*','!*.c','!*.h' and
@@ -160,6 +901,8 @@ def lines(settings={}):
     prio = settings.get("prio", 49)
     subprio = settings.get("subprio", 50)
     exfiles = settings.get("exclude_files", [".gitignore", ".p4ignore"])
+    workers = settings.get("workers", 1)
+    processes = settings.get("processes", 1)
     limit = settings.get("size_limit", 1 * 1024 * 1024)
     r = settings.get("filter", r"[a-zA-Z_0-9]")
     exclude = settings.get(
@@ -180,26 +923,22 @@ def lines(settings={}):
 
     logger.info("Index lines in files in {}", root.absolute().as_posix())
     t = time.perf_counter()
-    data = []
-    for p in _file_walk(root, exclude, exfiles):
-        size = p.stat().st_size
-        if size > limit:
-            logger.info("File too large: {} {}b", p, size)
-            continue
-        logger.info("indexing: {}", p)
-        with p.open("rt", encoding="utf-8", errors="replace") as f:
-            for i, line in enumerate(f):
-                line = line.strip()
-                if r.search(line):
-                    data.append((line, typ, p.as_posix(), None, i + 1, prio, subprio))
+    count = 0
+    if walk is not None:
+        walk = walk.join(exclude, exfiles, index)
+    else:
+        walk = _file_walk(root, exclude, exfiles, workers, index)
+    paths = _content_paths(walk, limit, index, logger)
+    for path, found in _scan_contents(paths, _file_lines, r, processes):
+        for line, _, lineno in found:
+            count += 1
+            yield (line, typ, path, None, lineno, prio, subprio)
 
     t = time.perf_counter() - t
-    logger.info("Indexed {} lines in {:.3f}s", len(data), t)
-
-    return data
+    logger.info("Indexed {} lines in {:.3f}s", count, t)
 
 
-def words(settings={}):
+def words(settings={}, index=None, walk=None):
     """Index lines of files.
 
     to only search some files, set exclude to '*','!*.c','!*.h' and
@@ -212,6 +951,8 @@ def words(settings={}):
     prio = settings.get("prio", 48)
     subprio = settings.get("subprio", 40)
     exfiles = settings.get("exclude_files", [".gitignore", ".p4ignore"])
+    workers = settings.get("workers", 1)
+    processes = settings.get("processes", 1)
     limit = settings.get("size_limit", 100 * 1024)
     r = settings.get("re", r"[a-zA-Z_][a-zA-Z_0-9]+")
     exclude = settings.get(
@@ -232,25 +973,19 @@ def words(settings={}):
 
     logger.info("Index words in files in {}", root.absolute().as_posix())
     t = time.perf_counter()
-    data = []
+    count = 0
 
-    for p in _file_walk(root, exclude, exfiles):
-        size = p.stat().st_size
-        if size > limit:
-            logger.info("File too large: {} {}b", p, size)
-            continue
-        logger.info("indexing: {}", p)
-        with p.open("rt", encoding="utf-8", errors="replace") as f:
-            for i, line in enumerate(f):
-                line = line.strip()
-                for m in r.finditer(line):
-                    data.append(
-                        (m.group(0), typ, p.as_posix(), line, i + 1, prio, subprio)
-                    )
+    if walk is not None:
+        walk = walk.join(exclude, exfiles, index)
+    else:
+        walk = _file_walk(root, exclude, exfiles, workers, index)
+    paths = _content_paths(walk, limit, index, logger)
+    for path, found in _scan_contents(paths, _file_words, r, processes):
+        for word, line, lineno in found:
+            count += 1
+            yield (word, typ, path, line, lineno, prio, subprio)
     t = time.perf_counter() - t
-    logger.info("Indexed {} words in {:.3f}", len(data), t)
-
-    return data
+    logger.info("Indexed {} words in {:.3f}", count, t)
 
 
 # ctags --list-kinds
@@ -328,7 +1063,262 @@ TAGS_DEFAULT_TYPE_MAP = {
 }
 
 
-def tags(settings={}):
+def _tag_type(type_map, ext, typ):
+    """Return (type, subprio) for a tag of kind typ in a file with extension ext."""
+    try:
+        return type_map[ext][typ]
+    except KeyError:
+        try:
+            return type_map["default"][typ]
+        except KeyError:
+            try:
+                typ2, subprio = type_map[typ]
+                subprio + 10  # ugly shit: raise TypeError for non int
+                typ2 + ""  # ugly shit: raise TypeError for non int
+                return typ2, subprio
+            except (KeyError, ValueError, TypeError):
+                try:
+                    return TAGS_DEFAULT_TYPE_MAP[ext][typ]
+                except KeyError:
+                    try:
+                        return TAGS_DEFAULT_TYPE_MAP["default"][typ]
+                    except KeyError:
+                        return f"X-{ext}-{typ}", 5
+
+
+def _parse_tags(lines, type_map, prio):
+    """Yield a row for each line of a tags file."""
+    types = {}  # (ext, kind) -> (type, subprio), resolved once per kind
+    for line in lines:
+        if line.startswith("!"):
+            continue
+        l = line.strip()
+
+        name, _, l = l.partition("\t")
+        file, _, l = l.partition("\t")
+        # location regex could contain tabs
+        location, _, l = l.rpartition(';"\t')
+
+        file = file.replace("\\", "/")
+        if file.startswith("./"):
+            file = file[2:]
+
+        if location.startswith("/"):
+            if location[-1] != "/":
+                raise ValueError(
+                    "Invalid Tags-location /../ expected", location, line
+                )
+        else:
+            if not all(c in "0123456789" for c in location):
+                raise ValueError(
+                    "Invalid Tags-location (/../ or number expected)",
+                    location,
+                    line,
+                )
+
+        typ = ""
+        extra = ""
+        for field in l.split("\t"):
+            if ":" not in field:
+                typ = field
+            else:
+                k, _, val = field.partition(":")
+                if k == "kind":
+                    typ = val
+                elif val:
+                    extra = extra + field + " "
+        ext = file.rpartition(".")[2]
+        ext = ext.rpartition("/")[2]
+        key = ext, typ
+        resolved = types.get(key)
+        if resolved is None:
+            resolved = types[key] = _tag_type(type_map, ext, typ)
+        typ, subprio = resolved
+        yield (name, typ, file, extra, location, prio, subprio)
+
+
+def _parse_tag_chunk(lines, type_map, prio):
+    """Parse a chunk of a tags file in a worker process."""
+    return list(_parse_tags(lines, type_map, prio))
+
+
+_CHUNK_TAGS = 20000
+
+
+class _Process:
+    """A subprocess whose stdin is fed and stderr drained by threads.
+
+    So its stdout can be read at leisure without it blocking on a full pipe.
+    """
+
+    def __init__(self, args, input=None, stdout=subprocess.PIPE, shell=False):
+        self.args = args
+        self.popen = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+            stdout=stdout,
+            stderr=subprocess.PIPE,
+            shell=shell,
+        )
+        self.stdout = self.popen.stdout
+        self._stderr = []
+        self._threads = [
+            threading.Thread(
+                target=lambda: self._stderr.append(self.popen.stderr.read()),
+                daemon=True,
+            )
+        ]
+        if input is not None:
+            self._threads.append(
+                threading.Thread(target=self._feed, args=(input,), daemon=True)
+            )
+        for t in self._threads:
+            t.start()
+
+    def _feed(self, input):
+        try:
+            with self.popen.stdin as stdin:
+                stdin.write(input)
+        except BrokenPipeError:
+            pass  # it will tell why on stderr
+
+    def finish(self, timeout=None):
+        """Wait for the process to exit and return its returncode and stderr."""
+        for t in self._threads:
+            t.join()
+        returncode = self.popen.wait(timeout=timeout)
+        return returncode, b"".join(self._stderr).decode(errors="replace")
+
+    def kill(self):
+        self.popen.kill()
+        self.popen.wait()
+
+
+def _shard_files(settings, shards):
+    """Split the files the files source would index into shards for ctags -L.
+
+    Uses the root, exclude, exclude_files and workers settings like files.
+    Shards get about the same number of bytes each."""
+    root = settings.get("root", ".")
+    exclude = settings.get("exclude", FILES_DEFAULT_EXCLUDE)
+    exfiles = settings.get("exclude_files", [".gitignore", ".p4ignore"])
+    workers = settings.get("workers", 1)
+
+    files = [
+        (_stat(path, entry).st_size, path)
+        for path, entry in _file_walk(root, exclude, exfiles, workers)
+    ]
+    files.sort(reverse=True)
+    result = [[] for _ in range(shards)]
+    heap = [(0, i) for i in range(shards)]
+    for size, path in files:
+        total, i = heapq.heappop(heap)
+        result[i].append(path)
+        heapq.heappush(heap, (total + size, i))
+    return [r for r in result if r]
+
+
+def _file_list(paths):
+    return "".join(p + "\n" for p in paths).encode(errors="surrogateescape")
+
+
+def _merged_lines(processes):
+    """Yield the lines of the processes' stdout, as they arrive."""
+    q = queue.Queue(maxsize=64)
+
+    def read(p):
+        try:
+            for chunk in _chunks(io.TextIOWrapper(p.stdout, errors="replace"), 1000):
+                q.put(chunk)
+        finally:
+            q.put(None)
+
+    for p in processes:
+        threading.Thread(target=read, args=(p,), daemon=True).start()
+    running = len(processes)
+    while running:
+        chunk = q.get()
+        if chunk is None:
+            running -= 1
+        else:
+            yield from chunk
+
+
+def _split_header(f):
+    """Return the !_ header lines of a tags file and an iterator of the rest."""
+    header = []
+    for line in f:
+        if not line.startswith(b"!_"):
+            return header, itertools.chain([line], f)
+        header.append(line)
+    return header, iter(())
+
+
+_TAG_FILE_SORTED = b"!_TAG_FILE_SORTED\t"
+
+
+def _merged_header(header):
+    """The header of the merged shards, whose first shard has header.
+
+    Merging keeps the order of shards sorted bytewise (`!_TAG_FILE_SORTED 1`)
+    only, others (e.g. from --sort=foldcase) are marked unsorted, so vim does
+    not binary search them.
+    """
+    return [
+        _TAG_FILE_SORTED + b"0" + line[len(_TAG_FILE_SORTED) + 1 :]
+        if line.startswith(_TAG_FILE_SORTED)
+        and not line.startswith(_TAG_FILE_SORTED + b"1")
+        else line
+        for line in header
+    ]
+
+
+def _run_sharded_command(command, tag_file, shards, settings, logger):
+    """Run command on shards of the files in parallel, merging to tag_file."""
+    args = shlex.split(command) if isinstance(command, str) else list(command)
+    t = time.perf_counter()
+    parts = _shard_files(settings, shards)
+    shard_files = [f"{tag_file}.shard{i}" for i in range(len(parts))]
+    processes = [
+        _Process(
+            args + ["-f", shard_file, "-L", "-"],
+            input=_file_list(paths),
+            stdout=subprocess.DEVNULL,
+        )
+        for shard_file, paths in zip(shard_files, parts)
+    ]
+    try:
+        for p in processes:
+            returncode, err = p.finish()
+            if returncode != 0:
+                raise OSError("Non 0 Return Code", returncode, err, p.args)
+        files = [open(f, "rb") for f in shard_files]
+        try:
+            split = [_split_header(f) for f in files]
+            with open(tag_file + ".tmp", "wb") as out:
+                if split:
+                    out.writelines(_merged_header(split[0][0]))
+                # each shard is sorted like ctags sorts, by name first
+                out.writelines(heapq.merge(*(body for _, body in split)))
+        finally:
+            for f in files:
+                f.close()
+        os.replace(tag_file + ".tmp", tag_file)
+    except BaseException:
+        for p in processes:
+            p.kill()
+        raise
+    finally:
+        for f in shard_files:
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+    t = time.perf_counter() - t
+    logger.info("%d ctags shards took %.3fs", len(processes), t)
+
+
+def tags(settings={}, index=None):
     logger = _logger.getChild("tags")
 
 
@@ -336,6 +1326,8 @@ def tags(settings={}):
     prio = settings.get("prio", 99)
     type_map = settings.get("type_map", {})
     command = settings.get("command")
+    processes = settings.get("processes", 1)
+    shards = settings.get("shards", 1)
 
     logger.debug("running ctags in %s, tag_file=%s, command=%s, prio=%d", pathlib.Path.cwd().absolute(), tag_file, command, prio)
 
@@ -343,21 +1335,24 @@ def tags(settings={}):
         if tag_file[0] == "!":
             raise ValueError("specifyiing both command and !file", command, tag_file)
         logger.info(f"running {command}")
-        t = time.perf_counter()
-        p = subprocess.Popen(
-            command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-        )
-        t = time.perf_counter() - t
-        if p.wait() == 0:
-            logger.info(
-                f"ctags took {t:.3f}s " + p.stdout.read() +  p.stderr.read()
-            )  # if --totals, print that
+        if shards > 1:
+            _run_sharded_command(command, tag_file, shards, settings, logger)
         else:
-            raise OSError("Non 0 Return Code", p.returncode, p.stderr.read(), command)
+            t = time.perf_counter()
+            p = subprocess.run(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+            )
+            t = time.perf_counter() - t
+            if p.returncode == 0:
+                logger.info(
+                    f"ctags took {t:.3f}s " + p.stdout + p.stderr
+                )  # if --totals, print that
+            else:
+                raise OSError("Non 0 Return Code", p.returncode, p.stderr, command)
 
     if not tag_file:
         for f in ".tags", "tags":
@@ -369,99 +1364,66 @@ def tags(settings={}):
 
     if tag_file[0] == "!":
         logger.info("running %s", tag_file)
-        t = time.perf_counter()
-        ctags_process = subprocess.Popen(
-            tag_file[1:],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True,
-        )
-        f = ctags_process.stdout
-        logger.debug("ctags process: %r", ctags_process)
+        started = time.perf_counter()
+        # tags are parsed while ctags runs, see _Process
+        if shards > 1:
+            ctags_processes = [
+                _Process(tag_file[1:] + " -L -", input=_file_list(paths), shell=True)
+                for paths in _shard_files(settings, shards)
+            ]
+            lines = _merged_lines(ctags_processes)
+        else:
+            ctags_processes = [_Process(tag_file[1:], shell=True)]
+            lines = io.TextIOWrapper(ctags_processes[0].stdout, errors="replace")
+        logger.debug("ctags processes: %r", ctags_processes)
+        if index is not None:
+            index.owner = tag_file
+            index.add(tag_file)
     else:
-        ctags_process = None
+        ctags_processes = []
+        if index is not None:
+            index.owner = tag_file
+            st = pathlib.Path(tag_file).stat()
+            if not index.check_contents(tag_file, st, _hash_file):
+                logger.info("%s did not change", tag_file)
+                return
         logger.info("Parsing %s", tag_file)
         tag_file = pathlib.Path(tag_file)
-        f = tag_file.open("rb")
+        lines = io.TextIOWrapper(tag_file.open("rb"), errors="replace")
 
-    f = io.TextIOWrapper(f, errors="replace")
+    count = 0
 
-    data = []
-
-    t = time.perf_counter() - t
-    with f:
-        for line in f:
-            if line.startswith("!"):
-                continue
-            l = line.strip()
-
-            name, _, l = l.partition("\t")
-            file, _, l = l.partition("\t")
-            # location regex could contain tabs
-            location, _, l = l.rpartition(';"\t')
-
-            file = file.replace("\\", "/")
-            if file.startswith("./"):
-                file = file[2:]
-
-            if location.startswith("/"):
-                if location[-1] != "/":
-                    raise ValueError(
-                        "Invalid Tags-location /../ expected", location, line
-                    )
+    t = time.perf_counter()
+    try:
+        with contextlib.closing(lines):
+            if processes > 1:
+                chunks = _chunks(lines, _CHUNK_TAGS)
+                results = _pool_map(
+                    processes, _parse_tag_chunk, chunks, type_map, prio
+                )
+                rows = itertools.chain.from_iterable(results)
             else:
-                if not all(c in "0123456789" for c in location):
-                    raise ValueError(
-                        "Invalid Tags-location (/../ or number expected)",
-                        location,
-                        line,
-                    )
-
-            typ = ""
-            extra = ""
-            for field in l.split("\t"):
-                if ":" not in field:
-                    typ = field
-                else:
-                    k, _, val = field.partition(":")
-                    if k == "kind":
-                        typ = val
-                    elif val:
-                        extra = extra + field + " "
-            ext = file.rpartition(".")[2]
-            ext = ext.rpartition("/")[2]
-            try:
-                typ, subprio = type_map[ext][typ]
-            except KeyError:
-                try:
-                    typ, subprio = type_map["default"][typ]
-                except KeyError:
-                    try:
-                        typ, subprio = type_map[typ]
-                        subprio + 10  # ugly shit: raise TypeError for non int
-                        typ + ""  # ugly shit: raise TypeError for non int
-                    except (KeyError, ValueError, TypeError):
-                        try:
-                            typ, subprio = TAGS_DEFAULT_TYPE_MAP[ext][typ]
-                        except KeyError:
-                            try:
-                                typ, subprio = TAGS_DEFAULT_TYPE_MAP["default"][typ]
-                            except KeyError:
-                                typ, subprio = f"X-{ext}-{typ}", 5
-            data.append((name, typ, file, extra, location, prio, subprio))
-
-    count = len(data)
+                rows = _parse_tags(lines, type_map, prio)
+            for row in rows:
+                count += 1
+                yield row
+    except BaseException:  # also when closed early because the update failed
+        for p in ctags_processes:
+            p.kill()
+        raise
+
     t = time.perf_counter() - t
     logger.debug(f"Parsed {count} tags in {t:.3f} seconds")
 
-    if ctags_process:
-        err = ctags_process.stderr.read().decode(errors="replace")
-        if ctags_process.wait(timeout=0.5) != 0: # we already read all of stdout and stderr, wait shouldn't take long
-            raise OSError("Non Zero returncode", ctags_process.returncode, tag_file, err)
-        if err:
-            logger.warn("command printed to stderr: %s", err)
-        if not data:
+    if ctags_processes:
+        for p in ctags_processes:
+            # we already read all of stdout and stderr, wait shouldn't take long
+            returncode, err = p.finish(timeout=0.5)
+            if returncode != 0:
+                raise OSError("Non Zero returncode", returncode, tag_file, err)
+            if err:
+                logger.warn("command printed to stderr: %s", err)
+        started = time.perf_counter() - started
+        logger.info("ctags ran for %.3fs, parsed while it ran", started)
+        if not count:
             logger.warn("No Tags from command ", tag_file)
-
-    return data
@@ -1,11 +1,16 @@
+import os
+import pathlib
+import tempfile
 import unittest
+from unittest import mock
 
+from . import complete
 from .complete import completion_results
 
 
 class CompletionTest(unittest.TestCase):
     def test_completion_lineno(self):
-        m = {"file": __file__, "location": "28", "name": "Hans"}
+        m = {"file": __file__, "location": "29", "name": "Hans"}
         c = completion_results([m], None)
         info = c["words"][0]["info"].split("\n")
         assert len(info) == 6
@@ -22,9 +27,58 @@ class CompletionTest(unittest.TestCase):
         assert "# Last ContextLine" == info[-2].strip()
 
     # TestString
-    # 2 KEEP TestString on Line 28
+    # 2 KEEP TestString on Line 29
     # 3
     # 4
     # Last ContextLine
     # 6
     # 7
+
+
+class FileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "a.py")
+        self.write("".join("line {}\n".format(i) for i in range(1, 11)))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, text):
+        with open(self.path, "w") as f:
+            f.write(text)
+
+    def infos(self, *locations):
+        matches = [
+            {"file": "a.py", "location": loc, "name": "x"} for loc in locations
+        ]
+        c = completion_results(matches, pathlib.Path(self.tmp.name))
+        return [w["info"] for w in c["words"]]
+
+    def test_locations(self):
+        infos = self.infos(None, "9", "/^line 2$/", "/^missing$/", "0", "11")
+        assert infos[0] == "line 1\nline 2\nline 3\nline 4\nline 5\n"
+        assert infos[1] == "line 9\nline 10\n"
+        assert infos[2] == "line 2\nline 3\nline 4\nline 5\nline 6\n"
+        assert infos[3:] == ["missing", "", ""]
+
+    def test_same_file_is_read_once(self):
+        init = complete._File.__init__
+        with mock.patch.object(
+            complete._File, "__init__", side_effect=init, autospec=True
+        ) as init:
+            self.infos("1", "2", "/^line 3$/")
+            self.infos("4")
+        assert init.call_count == 1
+
+    def test_big_and_head_only_files_are_not_cached(self):
+        with mock.patch.object(complete._FileCache, "MAX_FILE_SIZE", 10):
+            assert self.infos("2") == ["line 2\nline 3\nline 4\nline 5\nline 6\n"]
+            assert self.infos("/^line 9$/") == ["line 9\nline 10\n"]
+        assert self.infos(None) == ["line 1\nline 2\nline 3\nline 4\nline 5\n"]
+        assert complete._files.get(pathlib.Path(self.path), load=False) is None
+
+    def test_changed_file_is_reread(self):
+        assert self.infos("1") == ["line 1\nline 2\nline 3\nline 4\nline 5\n"]
+        self.write("new 1\n")
+        assert self.infos("1") == ["new 1\n"]
@@ -1,12 +1,18 @@
+import os.path
+import tempfile
+import threading
 import unittest
 
 from .db import DB
 from .query import tokenize
+from .scanner import FileIndex
 
 
 class DBTest(unittest.TestCase):
+    NAME_INDEX = False
+
     def setUp(self):
-        self.db = DB(":memory:")
+        self.db = DB(":memory:", name_index=self.NAME_INDEX)
         self.db.fill(
             [
                 [
@@ -59,3 +65,220 @@ class DBTest(unittest.TestCase):
         m = self.db.get(tokenize("order"))
         expected = ["order_0", "order_3", "order_2", "order_0", "order_1", "order_4_"]
         assert [r[0] for r in m] == expected
+
+    def test_update_source(self):
+        index = FileIndex()
+        index.check("a.c")
+        index.check("b.c")
+        self.db.update_source(
+            "src",
+            index,
+            [
+                ["a_old", "Word", "a.c", "", 1, 0, 0],
+                ["b_same", "Word", "b.c", "", 1, 0, 0],
+            ],
+        )
+        states = self.db.get_file_states("src")
+        assert states.keys() == {"a.c", "b.c"}
+
+        index = FileIndex({**states, "a.c": (1, 1, None)})
+        index.check("a.c")
+        index.check("b.c")
+        index.check("c.c")
+        self.db.update_source("src", index, [["c_new", "Word", "c.c", "", 1, 0, 0]])
+        self.db.retain_sources(["src"])
+
+        names = {r["name"] for r in self.db.get(tokenize("_"))}
+        assert names == {"b_same", "c_new"}
+
+    def test_touched_file_keeps_rows(self):
+        index = FileIndex()
+        index.owner = "tags"
+        index.check("tags", hash="h")
+        self.db.update_source("src", index, [["f", "Word", "f.c", "", 1, 0, 0]])
+
+        index = FileIndex(self.db.get_file_states("src"))
+        index.seen["tags"] = (1, 2, "h")
+        index.touched.add("tags")
+        self.db.update_source("src", index, [])
+        assert self.db.get_file_states("src") == {"tags": (1, 2, "h")}
+        assert [r["file"] for r in self.db.get(tokenize("f =Word"))] == ["f.c"]
+
+    def test_dir_listings(self):
+        index = FileIndex()
+        index.listed["src"] = (42, [("a.c", "f"), ("sub", "d")])
+        self.db.update_source("src", index, [])
+        assert self.db.get_dir_listings("src") == index.listed
+
+        self.db.retain_sources([])
+        assert self.db.get_dir_listings("src") == {}
+
+    def test_order_uses_rank_index(self):
+        reader = self.db._readers[0]
+        q = "EXPLAIN QUERY PLAN SELECT * FROM zem WHERE name LIKE '%o%' ORDER BY {}"
+        plan = reader._thread_worker.post_sync(
+            lambda: reader.con.execute(q.format(reader._ORDER)).fetchall()
+        )
+        assert any("zem_rank" in r["detail"] for r in plan)
+        assert not any("TEMP B-TREE" in r["detail"] for r in plan)
+
+    def test_refined_query_uses_cache(self):
+        m = self.db.get(tokenize("con"), limit=5)
+        assert [r["name"] for r in m] == ["CONST_A", "CONST_C"]
+        assert self.db._cache.lookup(tokenize("con_c")) is not None
+        m = self.db.get(tokenize("con_c"), limit=5)
+        assert [r["name"] for r in m] == ["CONST_C"]
+
+        self.db.fill([[["CONST_CC", "Define", "file.c", "", 1, 30, 5]]], wipe=False)
+        m = self.db.get(tokenize("con_c"), limit=5)
+        assert [r["name"] for r in m] == ["CONST_CC", "CONST_C"]
+
+    def test_cache_folds_ascii_only(self):
+        rows = [[name, "Word", "a.c", "", 1, 0, 0] for name in ("äbc", "Äbc")]
+        self.db.fill([rows], wipe=False)
+        assert [r["name"] for r in self.db.get(tokenize("ä"), limit=5)] == ["äbc"]
+        assert [r["name"] for r in self.db.get(tokenize("Ä"), limit=5)] == ["Äbc"]
+
+    def test_cache_does_not_read_past_limit(self):
+        self.db.fill([[["word", "Word", "w.c", "", 1, 0, 0]] * 2000], wipe=False)
+        reader = self.db._readers[0]
+        steps = 0
+
+        def count():
+            nonlocal steps
+            steps += 1
+
+        def vm_steps(query):
+            nonlocal steps
+            steps = 0
+            worker = reader._thread_worker
+            worker.post_sync(reader.con.set_progress_handler, (count, 1))
+            try:
+                self.db.get(tokenize(query), limit=2)
+            finally:
+                worker.post_sync(
+                    reader.con.set_progress_handler, (worker.is_stale, 1000)
+                )
+            return steps
+
+        cached = vm_steps("w")
+        reader.cache = None
+        try:
+            uncached = vm_steps("w")
+        finally:
+            reader.cache = self.db._cache
+        assert cached < 2 * uncached
+
+    def test_get_page(self):
+        self.db.fill(
+            [[["CONST_A", "Define", "file.c", "", 1, 20, 5]] * 3], wipe=False
+        )
+        expected = self.db.get(tokenize("_"))
+        pages = [self.db.get(tokenize("_"), limit=2)]
+        while pages[-1]:
+            pages.append(self.db.get_page(tokenize("_"), pages[-1][-1], 2))
+        assert [len(p) for p in pages] == [2, 2, 2, 1, 0]
+        assert [tuple(r) for p in pages for r in p] == [tuple(r) for r in expected]
+
+    def test_prefix_preview(self):
+        m = self.db._readers[-1].get_prefix(tokenize("co =De"), 20)
+        assert [r["name"] for r in m] == ["CONST_A", "CONST_C"]
+        m = self.db._readers[-1].get_prefix(tokenize("fa"), 20)
+        assert m == []  # file.a matches fa, but does not start with it
+        assert self.db._readers[-1].get_prefix(tokenize("_c"), 20) is None
+
+    def test_prefix_uses_name_index(self):
+        reader = self.db._readers[-1]
+        q = (
+            "EXPLAIN QUERY PLAN SELECT * FROM zem INDEXED BY zem_name WHERE name LIKE ?"
+        )
+        plan = reader._thread_worker.post_sync(
+            lambda: reader.con.execute(q, ["co%"]).fetchall()
+        )
+        assert any("SEARCH" in r["detail"] for r in plan)
+
+
+class DBNameIndexTest(DBTest):
+    NAME_INDEX = True
+
+    def setUp(self):
+        super().setUp()
+        self.db._readers[0].NAME_INDEX_MAX_FRACTION = 1
+
+    def test_name_index_narrows(self):
+        reader = self.db._readers[0]
+        where, params = reader._thread_worker.post_sync(
+            reader._tokens_to_where_clause, (tokenize("cnA"),)
+        )
+        assert "zem_gram" in where
+        m = self.db.get(tokenize("cnA"))
+        assert [r["name"] for r in m] == ["CONST_A"]
+
+    def test_name_index_wildcard(self):
+        m = self.db.get(tokenize("CONST_"))
+        assert len(m) == 2
+
+
+class DBUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = DB(os.path.join(self.tmp.name, "zem.sqlite"))
+        self.db.fill([[["old", "Word", "a.c", "", 1, 0, 0]]])
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_readers_see_old_index_until_commit(self):
+        index = FileIndex()
+        index.check("a.c")
+        self.db.begin_update()
+        self.db.fill([])
+        self.db.update_source("src", index, [["new", "Word", "a.c", "", 1, 0, 0]])
+        assert [r["name"] for r in self.db.get(tokenize("_"))] == ["old"]
+
+        self.db.commit_update()
+        assert [r["name"] for r in self.db.get(tokenize("_"))] == ["new"]
+
+    def test_readers_do_not_queue_behind_prompt(self):
+        blocked = threading.Event()
+        self.db._readers[0]._thread_worker.post_async(blocked.wait)
+        results = []
+        self.db.get_async(
+            tokens=tokenize("ol"),
+            callback=lambda tokens, result: results.append(result),
+        )
+        assert [r["name"] for r in self.db.get(tokenize("ol"))] == ["old"]
+        assert results == []
+        blocked.set()
+
+    def test_get_async_latest_wins(self):
+        blocked = threading.Event()
+        self.db._readers[0]._thread_worker.post_async(blocked.wait)
+        results = []
+        for q in "o", "ol", "old":
+            self.db.get_async(
+                tokens=tokenize(q),
+                callback=lambda tokens, result: results.append(tokens),
+            )
+        blocked.set()
+        self.db._readers[0].get_size()  # wait for the queued jobs
+        assert results == [tokenize("old")]
+
+    def test_overlapping_update_is_rejected(self):
+        self.db.begin_update()
+        self.db.fill([])
+        with self.assertRaises(RuntimeError):
+            self.db.begin_update()
+        assert [r["name"] for r in self.db.get(tokenize("_"))] == ["old"]
+        self.db.fill([[["new", "Word", "a.c", "", 1, 0, 0]]], wipe=False)
+        assert [r["name"] for r in self.db.get(tokenize("_"))] == ["old"]
+
+        self.db.commit_update()
+        assert [r["name"] for r in self.db.get(tokenize("_"))] == ["new"]
+
+    def test_rollback(self):
+        self.db.begin_update()
+        self.db.fill([])
+        self.db.rollback_update()
+        assert [r["name"] for r in self.db.get(tokenize("_"))] == ["old"]
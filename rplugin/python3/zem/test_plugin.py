@@ -0,0 +1,132 @@
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from .plugin import Plugin, QueryScheduler, diff_lines
+
+
+class DiffLinesTest(unittest.TestCase):
+    def check(self, old, new):
+        start, end, lines = diff_lines(old, new)
+        patched = list(old)
+        patched[start:end] = lines
+        assert patched == new
+        return len(lines)
+
+    def test_diff_lines(self):
+        assert self.check(["a", "b", "c"], ["a", "b", "c"]) == 0
+        assert self.check(["a", "b", "c"], ["a", "x", "c"]) == 1
+        assert self.check(["a", "b", "c"], ["x", "a", "b", "c"]) == 1
+        assert self.check(["a", "b", "c"], ["a", "b"]) == 0
+        assert self.check(["a", "a"], ["a", "a", "a"]) == 1
+        assert self.check([""], ["x", "y"]) == 2
+        assert self.check(["x", "y"], [""]) == 1
+
+
+class QuerySchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.sent = []
+        self.scheduler = QueryScheduler(self.sent.append, clock=lambda: self.now)
+
+    def test_fast_queries_are_sent_right_away(self):
+        self.scheduler.submit("a")
+        self.now += 0.001
+        self.scheduler.submit("ab")
+        assert self.sent == ["a", "ab"]
+        self.scheduler.done("ab")
+        assert self.scheduler.latency < QueryScheduler.FAST
+
+    def test_one_in_flight_one_pending(self):
+        self.scheduler.submit("a")
+        self.now += 0.1
+        self.scheduler.done("a")
+        self.scheduler.submit("ab")
+        self.scheduler.submit("abc")
+        self.scheduler.submit("abcd")
+        assert self.sent == ["a", "ab"]
+        self.now += 0.1
+        self.scheduler.done("ab")
+        assert self.sent == ["a", "ab", "abcd"]
+        self.scheduler.done("abcd")
+        assert self.sent == ["a", "ab", "abcd"]
+
+    def test_slow_queries_are_debounced(self):
+        self.scheduler.latency = 0.1 + QueryScheduler.SLOW
+        self.scheduler.submit("a")
+        self.scheduler.submit("ab")
+        assert self.sent == []
+        time.sleep(QueryScheduler.MAX_DELAY + 0.1)
+        assert self.sent == ["ab"]
+
+        self.scheduler.submit("abc")
+        self.scheduler.cancel()
+        time.sleep(QueryScheduler.MAX_DELAY + 0.1)
+        assert self.sent == ["ab"]
+
+    def test_lost_query_does_not_hold_back_the_next(self):
+        self.scheduler.LOST = 0.1
+        self.scheduler.latency = QueryScheduler.FAST
+        self.scheduler.submit("a")  # never done, e.g. the db was locked
+        self.scheduler.submit("ab")
+        assert self.sent == ["a"]
+        time.sleep(0.3)
+        assert self.sent == ["a", "ab"]
+        self.scheduler.cancel()
+
+
+class UpdateIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = pathlib.Path(self.tmp.name)
+        for i in range(20):
+            (root / "f{}.txt".format(i)).write_text("alpha beta gamma\n")
+        self.cwd = os.getcwd()
+
+        self.nvim = mock.Mock()
+        self.nvim.vars = {
+            "zem_sources": [["words", {"root": self.tmp.name}]],
+            "zem_batch_size": 1,
+            "zem_queue_size": 1,
+            "zem_loglevel": "critical",
+        }
+        self.nvim.funcs.getcwd.return_value = self.tmp.name
+        self.db = mock.Mock()
+        self.db.get_file_states.return_value = {}
+        self.db.get_dir_listings.return_value = {}
+        self.plugin = Plugin(self.nvim)
+        self.plugin.get_db = lambda: self.db
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def wait_for_update(self):
+        assert self.plugin._updating.acquire(timeout=3)
+        self.plugin._updating.release()
+        deadline = time.monotonic() + 3
+        while any(t.name.startswith("scan ") for t in threading.enumerate()):
+            assert time.monotonic() < deadline, "scanners did not stop"
+            time.sleep(0.01)
+
+    def test_failed_update_stops_scanners(self):
+        self.db.add_rows.side_effect = RuntimeError("disk full")
+        assert self.plugin.update_index(mock.Mock())
+        self.wait_for_update()
+        self.db.rollback_update.assert_called_once_with()
+        self.db.commit_update.assert_not_called()
+
+    def test_unreadable_index_fails_the_source(self):
+        self.db.get_file_states.side_effect = sqlite3.OperationalError("locked")
+        assert self.plugin.update_index(mock.Mock())
+        self.wait_for_update()
+        (key, index, failed), _ = self.db.finish_source.call_args
+        assert failed
+        self.db.commit_update.assert_called_once_with()
+        assert self.plugin.update_index(mock.Mock())  # not stuck
+        self.wait_for_update()
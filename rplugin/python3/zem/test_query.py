@@ -1,6 +1,6 @@
 import unittest
 
-from .query import tokenize
+from .query import refines, tokenize
 
 
 class TokenizeTest(unittest.TestCase):
@@ -24,3 +24,20 @@ class TokenizeTest(unittest.TestCase):
         assert [(tt.attribute, v) for (tt, v) in t] == [
             ("name", "aBC"),
         ]
+
+
+class RefinesTest(unittest.TestCase):
+    def test_refines_extended(self):
+        assert refines(tokenize("foo"), tokenize("fo"))
+        assert refines(tokenize("fXo"), tokenize("fo"))
+        assert refines(tokenize("fo bar"), tokenize("fo"))
+        assert refines(tokenize("FO =De"), tokenize("fo"))
+        assert refines(tokenize("fo =Def"), tokenize("fo =De"))
+
+    def test_refines_not(self):
+        assert not refines(tokenize("fo"), tokenize("foo"))
+        assert not refines(tokenize("of"), tokenize("fo"))
+        assert not refines(tokenize("fo =De =Fi"), tokenize("fo =De"))
+        assert not refines(tokenize("fo"), tokenize("fo =De"))
+        assert not refines(tokenize("!foo"), tokenize("!fo"))
+        assert not refines(tokenize("Ä"), tokenize("ä"))
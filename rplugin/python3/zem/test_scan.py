@@ -1,7 +1,29 @@
 import os.path
+import pathlib
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
-from .scanner import _translate, files
+from .scanner import (
+    FileIndex,
+    SharedWalk,
+    _line_pattern,
+    _file_lines,
+    _file_walk,
+    _file_words,
+    _git_files,
+    _Matcher,
+    _translate,
+    files,
+    lines,
+    tags,
+    words,
+)
 
 
 class ScanTest(unittest.TestCase):
@@ -127,7 +149,344 @@ class ScanTest(unittest.TestCase):
             "exclude": ["*.pyc"],
             "type": "File",
         }
-        rows = files(settings)
+        rows = list(files(settings))
 
         assert any(r[0].endswith(os.path.basename("test_scan.py")) for r in rows)
         assert not any(r[0].endswith(".pyc") for r in rows)
+
+    def test_scanfiles_incremental(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = pathlib.Path(d)
+            (root / "sub").mkdir()
+            for f in "a.py", "b.pyc", "sub/c.py":
+                (root / f).touch()
+            settings = {"root": d, "exclude": ["*.pyc"], "type": "File"}
+            index = FileIndex()
+            rows = list(files(settings, index))
+            assert sorted(r[0] for r in rows) == ["a.py", "c.py"]
+            assert index.changed == {d + "/a.py", d + "/sub/c.py"}
+
+            index = FileIndex({**index.seen, "gone.py": (0, 0, None)})
+            rows = list(files(settings, index))
+            assert rows == []
+            assert index.removed == {"gone.py"}
+
+    def test_walk_ignore_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = pathlib.Path(d)
+            (root / "sub").mkdir()
+            (root / ".gitignore").write_text("ign*\n")
+            (root / "sub" / ".gitignore").write_text("x\n")
+            for f in "ign1", "keep", "sub/ign2", "sub/x", "sub/y":
+                (root / f).touch()
+
+            paths = [p for p, _ in _file_walk(d, [".git*"], [".gitignore"])]
+            assert sorted(paths) == [d + "/keep", d + "/sub/y"]
+
+    def test_matcher(self):
+        rules = _translate(
+            ["*.o", "build/", "/root.txt", "!keep.o", "a?c", "docs/**/*.md", "x.y"]
+        )
+        rules += _translate(["name", "!*.txt", "deep/name.py"], "sub.dir")
+        matcher = _Matcher(rules)
+
+        def excluded(s, isdir):
+            for r, d, n in reversed(rules):
+                if not (d and not isdir) and r.match(s):
+                    return not n
+            return False
+
+        paths = [
+            "a.o", "x/keep.o", "build", "x/build", "root.txt", "x/root.txt",
+            "abc", "x/abc", "docs/a/b.md", "docs/b.txt", "x.y", "xzy",
+            "sub.dir/name", "sub.dir/x/name.txt", "subxdir/name",
+            "sub.dir/deep/name.py", "sub.dir/x/deep/name.py", "other/name",
+        ]  # fmt: skip
+        for s in paths:
+            for isdir in False, True:
+                assert matcher.excluded(s, isdir) == excluded(s, isdir), (s, isdir)
+
+    def test_parallel_walk(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = pathlib.Path(d)
+            (root / ".gitignore").write_text("*.o\n")
+            for i in range(5):
+                sub = root / f"d{i}" / "sub"
+                sub.mkdir(parents=True)
+                (sub / ".gitignore").write_text("!keep.o\n")
+                for f in "a.c", "a.o", "keep.o":
+                    (sub / f).touch()
+                    (sub.parent / f).touch()
+
+            walk = lambda workers: [
+                p for p, _ in _file_walk(d, [], [".gitignore"], workers)
+            ]
+            sequential = walk(1)
+            assert len(sequential) == 1 + 5 * (1 + 3)
+            assert sorted(walk(4)) == sorted(sequential)
+
+            it = _file_walk(d, [], [".gitignore"], 4)
+            next(it)
+            it.close()
+
+    def test_process_pool(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = pathlib.Path(d)
+            for i in range(100):
+                (root / f"f{i}.c").write_text(f"int f{i}(void);\n\nreturn {i};\n")
+            (root / "tags").write_text(
+                "".join(f"f{i}\tf{i}.c\t1;\"\tp\n" for i in range(100))
+            )
+
+            settings = {"root": d, "exclude": ["tags"]}
+            rows = sorted(lines(settings))
+            assert len(rows) == 200
+            assert sorted(lines({**settings, "processes": 2})) == rows
+
+            settings = {"file": str(root / "tags")}
+            rows = list(tags(settings))
+            assert len(rows) == 100
+            assert list(tags({**settings, "processes": 2})) == rows
+
+    def test_file_lines(self):
+        contents = [
+            b"",
+            b"\n\n",
+            b"  foo bar\n\tx\n\n  \n",
+            b"crlf\r\nline\r\n",
+            b"lone\rcr\n",
+            b"no newline",
+            "caf\u00e9 na\u00efve \u00a0x\u00a0\n".encode(),
+            b"bad \xff utf8\n",
+            b"bin\0ary\nfoo\n",
+            b"foo\n" * 100 + b"x\n" + b"\n" * 1000 + b"foo\n" * 200,
+        ]
+        patterns = [r"[a-zA-Z_0-9]", r"[a-zA-Z_][a-zA-Z_0-9]+", r"\w+", "a*", "x|oo"]
+        assert _line_pattern(re.compile(patterns[1])) is not None
+        assert _line_pattern(re.compile(patterns[2])) is None
+
+        def naive(path, r, words):
+            with open(path, "rt", encoding="utf-8", errors="replace") as f:
+                for i, line in enumerate(f):
+                    line = line.strip()
+                    if words:
+                        for m in r.finditer(line):
+                            yield m.group(0), line, i + 1
+                    elif r.search(line):
+                        yield line, None, i + 1
+
+        with tempfile.TemporaryDirectory() as d:
+            for i, content in enumerate(contents):
+                path = os.path.join(d, str(i))
+                with open(path, "wb") as f:
+                    f.write(content)
+                for p in patterns:
+                    r = re.compile(p)
+                    if b"\0" in content:
+                        assert list(_file_lines(path, r)) == []
+                        continue
+                    assert list(_file_lines(path, r)) == list(naive(path, r, False))
+                    assert list(_file_words(path, r)) == list(naive(path, r, True))
+
+    @unittest.skipUnless(shutil.which("git"), "needs git")
+    def test_git_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            assert _git_files(d, []) is None
+
+            root = pathlib.Path(d)
+            (root / "sub").mkdir()
+            (root / ".gitignore").write_text("*.o\n")
+            for f in "a.c", "a.o", "gone.c", "sub/b.c", "sub/b~", "untracked.c":
+                (root / f).touch()
+            git = lambda *args: subprocess.run(["git", "-C", d, *args], check=True)
+            git("init", "-q")
+            git("add", ".gitignore", "a.c", "gone.c", "sub")
+            (root / "gone.c").unlink()
+
+            settings = {"root": d, "exclude": [".*", "*~"]}
+            rows = sorted(files({**settings, "git": True}))
+            assert rows == sorted(files(settings))
+            assert [r[0] for r in rows] == ["a.c", "b.c", "untracked.c"]
+
+            # the walk yields the files in a linked directory and a nested
+            # repository, git lists their directories
+            (root / "linkdir").symlink_to("sub")
+            git("add", "linkdir")
+            assert _git_files(d, settings["exclude"]) is None
+            (root / "linkdir").unlink()
+            git("rm", "-q", "--cached", "linkdir")
+            (root / "nested").mkdir()
+            (root / "nested" / "n.c").touch()
+            subprocess.run(["git", "-C", root / "nested", "init", "-q"], check=True)
+            assert _git_files(d, settings["exclude"]) is None
+            rows = sorted(files({**settings, "git": True}))
+            assert rows == sorted(files(settings))
+            assert [r[0] for r in rows] == ["a.c", "b.c", "n.c", "untracked.c"]
+
+    def test_walk_reuses_listings(self):
+        with tempfile.TemporaryDirectory() as d:
+            sub = pathlib.Path(d) / "sub"
+            sub.mkdir()
+            (sub / "a.c").touch()
+            st = sub.stat()
+
+            index = FileIndex()
+            assert [r[0] for r in files({"root": d}, index)] == ["a.c"]
+            assert len(index.listed) == 2
+
+            # a change that keeps the mtime is not seen
+            (sub / "b.c").touch()
+            os.utime(sub, ns=(st.st_atime_ns, st.st_mtime_ns))
+            index = FileIndex(index.seen, index.listed)
+            assert list(files({"root": d}, index)) == []
+            assert index.removed == set()
+
+            os.utime(sub)
+            index = FileIndex(index.seen, index.listed)
+            assert [r[0] for r in files({"root": d}, index)] == ["b.c"]
+
+    def test_shared_walk(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = pathlib.Path(d)
+            (root / "sub").mkdir()
+            (root / ".hidden").mkdir()
+            (root / ".gitignore").write_text("*.o\n")
+            (root / "sub" / ".gitignore").write_text("big.c\n")
+            for f in "a.c", "a.o", "sub/b.c", "sub/big.c", ".hidden/h.c":
+                (root / f).write_text("int x;\n")
+
+            jobs = [
+                (files, {"root": d, "exclude": []}),
+                (lines, {"root": d, "exclude_files": []}),
+                (words, {"root": d, "exclude": ["*.o"]}),
+            ]
+            walk = SharedWalk(d, len(jobs) + 1)
+            results = [None] * len(jobs)
+
+            def run(i, func, settings):
+                consumer = walk.consumer()
+                try:
+                    results[i] = sorted(func(settings, FileIndex(), consumer))
+                finally:
+                    consumer.close()
+
+            threads = [
+                threading.Thread(target=run, args=(i, *job))
+                for i, job in enumerate(jobs)
+            ]
+            for t in threads:
+                t.start()
+            walk.consumer().close()  # a source that fails before joining
+            for t in threads:
+                t.join(10)
+            assert results == [sorted(func(settings)) for func, settings in jobs]
+            assert sorted(r[2] for r in results[0]) == [
+                d + "/.gitignore",
+                d + "/.hidden/h.c",
+                d + "/a.c",
+                d + "/sub/.gitignore",
+                d + "/sub/b.c",
+            ]
+
+    def test_shared_walk_is_bounded(self):
+        with tempfile.TemporaryDirectory() as d:
+            for i in range(50):
+                (pathlib.Path(d) / "f{}.c".format(i)).touch()
+            walk = SharedWalk(d, 2)
+            walk.BATCH_SIZE = 1
+            walk.MAX_BATCHES = 4
+            slow, gone = walk.consumer(), walk.consumer()
+
+            def stop_reading():
+                paths = gone.join([], [])
+                next(paths)
+                paths.close()  # must not block the walk
+
+            t = threading.Thread(target=stop_reading)
+            t.start()
+            paths = slow.join([], [])
+            first = next(paths)
+            t.join(10)
+            time.sleep(0.3)
+            assert slow.queue.qsize() <= walk.MAX_BATCHES
+            assert len([first, *paths]) == 50
+            slow.close()
+
+    def test_tags_command_stderr(self):
+        with tempfile.TemporaryDirectory() as d:
+            script = os.path.join(d, "ctags.py")
+            with open(script, "w") as f:
+                # more stderr than a pipe buffers, before the first tag
+                f.write("import sys\n")
+                f.write("sys.stderr.write('x' * 1000000)\n")
+                f.write("print('f\\tf.c\\t1;\"\\tp')\n")
+            settings = {"file": f'!"{sys.executable}" "{script}"'}
+            rows = list(tags(settings))
+            assert rows == [("f", "ProtoFunc", "f.c", "", "1", 99, 70)]
+
+    def test_tags_shards(self):
+        fake_ctags = "\n".join(
+            [
+                "import sys",
+                "args = sys.argv[1:]",
+                "assert args[-2:] == ['-L', '-']",
+                "paths = sys.stdin.read().split()",
+                "lines = sorted(p.rpartition('/')[2] + '\\t' + p + '\\t1;\"\\tf\\n'",
+                "               for p in paths)",
+                "out = sys.stdout",
+                "if '-f' in args:",
+                "    out = open(args[args.index('-f') + 1], 'w')",
+                "mode = '2' if '--sort=foldcase' in args else '1'",
+                "out.write('!_TAG_FILE_SORTED\\t' + mode + '\\t//\\n')",
+                "out.writelines(lines)",
+            ]
+        )
+        with tempfile.TemporaryDirectory() as d, tempfile.TemporaryDirectory() as t:
+            script = os.path.join(t, "ctags.py")
+            with open(script, "w") as f:
+                f.write(fake_ctags)
+            names = [f"f{i}.c" for i in range(20)]
+            for name in names:
+                (pathlib.Path(d) / name).write_text("x" * len(name))
+
+            settings = {"root": d, "shards": 3}
+            cmd = f'!"{sys.executable}" "{script}"'
+            rows = list(tags({**settings, "file": cmd}))
+            assert sorted(r[0] for r in rows) == sorted(names)
+
+            tag_file = os.path.join(t, "tags")
+            settings["command"] = [sys.executable, script]
+            rows = list(tags({**settings, "file": tag_file}))
+            assert [r[0] for r in rows] == sorted(names)
+            assert sorted(os.listdir(t)) == ["ctags.py", "tags"]
+            with open(tag_file) as f:
+                assert f.readline() == "!_TAG_FILE_SORTED\t1\t//\n"
+
+            # the merge only keeps a bytewise order
+            settings["command"].append("--sort=foldcase")
+            rows = list(tags({**settings, "file": tag_file}))
+            assert sorted(r[0] for r in rows) == sorted(names)
+            with open(tag_file) as f:
+                assert f.readline() == "!_TAG_FILE_SORTED\t0\t//\n"
+
+    def test_tags_unchanged_contents(self):
+        with tempfile.TemporaryDirectory() as d:
+            tag_file = os.path.join(d, "tags")
+            with open(tag_file, "w") as f:
+                f.write('f\tf.c\t1;"\tp\n')
+            settings = {"file": tag_file}
+
+            index = FileIndex()
+            assert len(list(tags(settings, index))) == 1
+
+            os.utime(tag_file, ns=(1, 1))
+            index = FileIndex(index.seen)
+            assert list(tags(settings, index)) == []
+            assert index.touched == {tag_file}
+            assert index.seen[tag_file][0] == 1
+
+            with open(tag_file, "a") as f:
+                f.write('g\tg.c\t1;"\tp\n')
+            index = FileIndex(index.seen)
+            assert len(list(tags(settings, index))) == 2
+            assert index.changed == {tag_file}
@@ -90,6 +90,39 @@ class TWTest(unittest.TestCase):
         assert l == [42]
         assert r == []
 
+    def test_coalescing(self):
+        l = []
+
+        @self.tw.coalescing_call("k")
+        def f(i):
+            l.append(i)
+
+        @self.tw.sync_call
+        def g():
+            f(1)
+            f(2)
+            f(3)
+
+        g()
+        time.sleep(0.1)
+        assert l == [3]
+
+    def test_stale(self):
+        l = []
+
+        @self.tw.coalescing_call("k")
+        def f(i):
+            while not self.tw.is_stale():
+                time.sleep(0.01)
+            l.append(i)
+
+        f(1)
+        time.sleep(0.1)
+        assert l == []
+        self.tw.cancel("k")
+        time.sleep(0.1)
+        assert l == [1]
+
     def test_stop_joins(self):
         l = []
 
@@ -16,12 +16,20 @@ class ThreadWorker(threading.Thread):
     def __init__(self, *, name=None, daemon=None):
         super().__init__(name=name, daemon=daemon)
         self._q = queue.Queue()
+        self._stopped = False
+        self._generations = {}  # key -> generation of the latest job
+        self._generations_lock = threading.Lock()
+        self._current = None  # (key, generation) of the running job
 
     def run(self):
-        while True:
-            f, evt, args, kwargs = self._q.get()
+        while not self._stopped:
+            f, evt, args, kwargs, key, generation = self._q.get()
             if f is self.STOP:
                 return
+            if key is not None:
+                if self._generations[key] != generation:
+                    continue  # superseded by a newer job with the same key
+                self._current = key, generation
             if evt:
                 try:
                     evt.res = f(*args, **kwargs)
@@ -35,9 +43,39 @@ class ThreadWorker(threading.Thread):
                     warnings.warn(
                         UserWarning("Uncought Exception in Threadworker Job", ex)
                     )
-
-    def post_async(self, f, args=(), kwargs={}):
-        self._q.put((f, None, args, kwargs))
+            self._current = None
+
+    def post_async(self, f, args=(), kwargs={}, key=None):
+        """Queue f(*args, **kwargs).
+
+        If key is given, only the latest job posted with that key runs, older
+        ones that did not start yet are dropped, see also `is_stale`.
+        """
+        generation = None
+        if key is not None:
+            generation = self._next_generation(key)
+        self._q.put((f, None, args, kwargs, key, generation))
+
+    def cancel(self, key):
+        """Drop all jobs posted with key and mark the running one stale."""
+        self._next_generation(key)
+
+    def _next_generation(self, key):
+        with self._generations_lock:
+            generation = self._generations.get(key, 0) + 1
+            self._generations[key] = generation
+        return generation
+
+    def is_stale(self):
+        """Whether the running job was superseded or cancelled.
+
+        Long running jobs with a key can poll this to abort early.
+        """
+        current = self._current
+        if current is None:
+            return False
+        key, generation = current
+        return self._generations[key] != generation
 
     def post_sync(self, f, args=(), kwargs={}, timeout=None):
         if threading.current_thread() == self:
@@ -46,7 +84,7 @@ class ThreadWorker(threading.Thread):
         if not self.is_alive():
             raise self.NotStarted()
         evt = threading.Event()
-        self._q.put((f, evt, args, kwargs))
+        self._q.put((f, evt, args, kwargs, None, None))
         if not evt.wait(timeout):
             raise ThreadWorker.Timeout()
         try:
@@ -57,8 +95,9 @@ class ThreadWorker(threading.Thread):
     def stop(self, timeout=None):
         if threading.current_thread() == self:
             self._stopped = True
-        else:
+        elif self.is_alive():
             self.post_sync(self.stop, timeout=timeout)
+            self.join(timeout)
 
     def __del__(self):
         if self.is_alive():
@@ -83,6 +122,18 @@ class ThreadWorker(threading.Thread):
 
         return proxy
 
+    def coalescing_call(self, key):
+        """Like async_call, but only the latest pending call runs."""
+
+        def deco(f):
+            @functools.wraps(f)
+            def proxy(*args, **kwargs):
+                self.post_async(f, args, kwargs, key=key)
+
+            return proxy
+
+        return deco
+
     def sync_call(self, f):
         @functools.wraps(f)
         def proxy(*args, **kwargs):
@@ -115,6 +166,17 @@ class ThreadWorkerMixin:
 
         return proxy
 
+    @staticmethod
+    def coalescing_call(key):
+        def deco(f):
+            @functools.wraps(f)
+            def proxy(*args, **kwargs):
+                args[0]._thread_worker.post_async(f, args, kwargs, key=key)
+
+            return proxy
+
+        return deco
+
     @staticmethod
     def sync_call(timeout_or_function):
         def deco(f):